@@ -0,0 +1,187 @@
+import click
+import time
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+from utility.dataset import Preprocess_Dataset
+from utility.transform import ExtractMel, datasetFeatures
+from utility.common import decodeSSM, encodeSSM, logSSM
+from utility.metrics import getMetric
+from models.selfSimilarity import selfSimilarityMatrix
+from models.seqRecur import buildRecurrence, cliquesFromSSM
+from models.classifier import ChorusClassifier, chorusDetection
+from models.pickSingle import tuneIntervals
+from configs.configs import METRIC_NAMES, logger, makeDirs
+from configs.modelConfigs import CHORUS_DURATION, TUNE_WINDOW
+from configs.trainingConfigs import CHORUS_CLASSIFIER_TRAIN_DATA_FILE, usingDataset
+
+
+def timedSSM(wavPath, mel, **kwargs):
+    start = time.time()
+    res = selfSimilarityMatrix(wavPath, mel=mel, **kwargs)
+    return time.time() - start, res
+
+
+def chorusMetric(ssm, times, mels_f, gt, clf):
+    # seqRecur pipeline on an in-memory log ssm
+    ssm_f = times, ssm
+    cliques = buildRecurrence(cliquesFromSSM(ssm_f), times)
+    mirexFmt = chorusDetection(cliques, times, mels_f, clf)
+    mirexFmt = tuneIntervals(
+        mirexFmt, mels_f, chorusDur=CHORUS_DURATION, window=TUNE_WINDOW
+    )
+    return getMetric(gt, mirexFmt)
+
+
+@click.group()
+def cli():
+    makeDirs()
+
+
+@click.command()
+@click.option("--dim", nargs=1, type=click.INT, default=128)
+@click.option(
+    "--method", nargs=1, type=click.Choice(["projection", "pca"]), default="projection"
+)
+@click.option("--count", nargs=1, type=click.INT, default=10)
+def reduce(dim, method, count):
+    """dense vs reduced stacked features: ssm time, fused ssm drift and chorus metric drift"""
+    dataset = usingDataset()
+    tf = ExtractMel()
+    mel_set = Preprocess_Dataset(tf.identifier, dataset, transform=tf.transform)
+    clf = ChorusClassifier(CHORUS_CLASSIFIER_TRAIN_DATA_FILE["seqRecur"])
+    rows = []
+    for idx in range(min(count, len(dataset))):
+        sample = dataset[idx]
+        melSample = mel_set[idx]
+        mels_f = melSample["times"], melSample["input"]
+        tDense, dense = timedSSM(sample["wavPath"], mels_f, reduce_dim=None)
+        tReduced, reduced = timedSSM(
+            sample["wavPath"], mels_f, reduce_dim=dim, reduce_method=method
+        )
+        times = dense["times"]
+        Wd, Wr = dense["Ws"]["Fused"], reduced["Ws"]["Fused"]
+        drift = np.linalg.norm(Wr - Wd) / np.linalg.norm(Wd)
+        metricDense = chorusMetric(logSSM(Wd), times, mels_f, sample["gt"], clf)
+        metricReduced = chorusMetric(logSSM(Wr), times, mels_f, sample["gt"], clf)
+        row = {
+            "title": sample["title"],
+            "frames": len(times) - 1,
+            "denseTime": tDense,
+            "reducedTime": tReduced,
+            "speedup": tDense / tReduced,
+            "fusedDrift": drift,
+        }
+        for name, d, r in zip(METRIC_NAMES, metricDense, metricReduced):
+            row[f"{name}Drift"] = r - d
+        logger.info(f"{row}")
+        rows.append(row)
+    df = pd.DataFrame(rows).set_index("title")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(df)
+        print(df.mean(numeric_only=True))
+
+
+def frameLabels(cliques, size):
+    labels = np.zeros(size, dtype=int)
+    for i, clique in enumerate(cliques):
+        labels[clique] = i
+    return labels
+
+
+@click.command()
+@click.option("--count", nargs=1, type=click.INT, default=10)
+def storage(count):
+    """stored size of the log ssm per dtype/compression, clique label agreement and chorus metric drift"""
+    options = {
+        "float32": (np.float32, False),
+        "float16": (np.float16, False),
+        "float16+zlib": (np.float16, True),
+    }
+    dataset = usingDataset()
+    features = datasetFeatures(dataset)
+    clf = ChorusClassifier(CHORUS_CLASSIFIER_TRAIN_DATA_FILE["seqRecur"])
+    rows = []
+    for idx in range(min(count, len(dataset))):
+        sample = dataset[idx]
+        (times, ssm), mels_f = features[idx]
+        ssm = np.asarray(ssm, dtype=np.float64)
+        baseCliques = frameLabels(cliquesFromSSM((times, ssm)), len(ssm))
+        baseMetric = chorusMetric(ssm, times, mels_f, sample["gt"], clf)
+        row = {"title": sample["title"], "float64 bytes": ssm.nbytes}
+        for name, (dtype, compress) in options.items():
+            # no tolerance, the drift of the lossy dtype itself is measured
+            stored = encodeSSM(ssm, dtype, compress, tolerance=np.inf)
+            size = len(stored.data) if compress else stored.nbytes
+            decoded = np.asarray(decodeSSM(stored))
+            cliques = frameLabels(cliquesFromSSM((times, decoded)), len(ssm))
+            metric = chorusMetric(decoded, times, mels_f, sample["gt"], clf)
+            row[f"{name} ratio"] = size / ssm.nbytes
+            row[f"{name} maxErr"] = np.max(np.abs(decoded - ssm))
+            row[f"{name} ARI"] = adjusted_rand_score(baseCliques, cliques)
+            for metricName, b, m in zip(METRIC_NAMES, baseMetric, metric):
+                if metricName in ["ovlp-F", "sovl-F"]:
+                    row[f"{name} {metricName}Drift"] = m - b
+        logger.info(f"{row}")
+        rows.append(row)
+    df = pd.DataFrame(rows).set_index("title")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(df.T)
+        print(df.mean(numeric_only=True))
+
+
+@click.command()
+@click.option("--count", nargs=1, type=click.INT, default=10)
+def sparse(count):
+    """dense vs sparse k-NN ssm: ssm time, stored entries, clique/recurrence label agreement and chorus metric drift"""
+    dataset = usingDataset()
+    tf = ExtractMel()
+    mel_set = Preprocess_Dataset(tf.identifier, dataset, transform=tf.transform)
+    clf = ChorusClassifier(CHORUS_CLASSIFIER_TRAIN_DATA_FILE["seqRecur"])
+    rows = []
+    for idx in range(min(count, len(dataset))):
+        sample = dataset[idx]
+        melSample = mel_set[idx]
+        mels_f = melSample["times"], melSample["input"]
+        tDense, dense = timedSSM(sample["wavPath"], mels_f, use_sparse=False)
+        tSparse, knn = timedSSM(sample["wavPath"], mels_f, use_sparse=True)
+        times = dense["times"]
+        size = len(times) - 1
+        Wd, Ws = logSSM(dense["Ws"]["Fused"]), logSSM(knn["Ws"]["Fused"])
+        cliquesDense = cliquesFromSSM((times, Wd))
+        cliquesSparse = cliquesFromSSM((times, Ws))
+        recurDense = buildRecurrence(cliquesDense, times)
+        recurSparse = buildRecurrence(cliquesSparse, times)
+        metricDense = chorusMetric(Wd, times, mels_f, sample["gt"], clf)
+        metricSparse = chorusMetric(Ws, times, mels_f, sample["gt"], clf)
+        row = {
+            "title": sample["title"],
+            "frames": size,
+            "denseTime": tDense,
+            "sparseTime": tSparse,
+            "density": Ws.nnz / size**2,
+            "denseCliques": len(cliquesDense),
+            "sparseCliques": len(cliquesSparse),
+            "cliqueARI": adjusted_rand_score(
+                frameLabels(cliquesDense, size), frameLabels(cliquesSparse, size)
+            ),
+            "recurrenceARI": adjusted_rand_score(
+                frameLabels(recurDense, size), frameLabels(recurSparse, size)
+            ),
+        }
+        for name, d, s in zip(METRIC_NAMES, metricDense, metricSparse):
+            row[f"{name}Drift"] = s - d
+        logger.info(f"{row}")
+        rows.append(row)
+    df = pd.DataFrame(rows).set_index("title")
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(df)
+        print(df.mean(numeric_only=True))
+
+
+cli.add_command(reduce)
+cli.add_command(storage)
+cli.add_command(sparse)
+if __name__ == "__main__":
+    cli()
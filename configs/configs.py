@@ -65,7 +65,7 @@ formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(messag
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
-# make these directories
+# directories made by the entry points, nothing is created at import
 mk_dirs = [
     EVAL_RESULT_DIR,
     MODELS_DIR,
@@ -74,13 +74,38 @@ mk_dirs = [
     ALGO_BASE_DIRS["TmpDir"],
     DATASET_BASE_DIRS["LocalTemporary_Dataset"],
 ]
-for path in mk_dirs:
-    if not os.path.exists(path):
-        dirname = os.path.dirname(path)
-        if os.path.exists(dirname):
-            os.mkdir(path)
-        else:
-            logger.warn(f"directory={dirname} does not exist")
+
+
+def makeDirs():
+    for path in mk_dirs:
+        if not os.path.exists(path):
+            dirname = os.path.dirname(path)
+            if os.path.exists(dirname):
+                os.mkdir(path)
+            else:
+                logger.warn(f"directory={dirname} does not exist")
+
 
 # process numbers for parallel computing
 NUM_WORKERS = os.cpu_count() // 2 if not DEBUG else 1
+# threads per process for the per-modality ssm branches, the cores left by the pool
+SSM_THREADS = max(1, os.cpu_count() // max(NUM_WORKERS, 1))
+# keep the melody extraction model resident in one subprocess per worker
+MELODY_WORKER = True
+# songs predicted together by a melody worker, and the predict batch size (windows)
+MELODY_BATCH_SONGS = 8
+MELODY_BATCH_SIZE = 256
+# longer songs are streamed in chunks of this many 31-frame windows (~10 minutes),
+# the stft waits in a temporary file, only the decoded signal is held whole
+MELODY_CHUNK_WINDOWS = 2048
+# preprocessed features: "npy" one memory-mapped file per array, "pkl" one pickle per song,
+# "shard" a few append-only shard files with an index per transform (large catalogs)
+FEATURE_STORE = "npy"
+# shard files of a new shard store
+SHARD_COUNT = 8
+# attempts after the first one for a song that fails to build
+BUILD_RETRIES = 1
+# durations, sample rates, channels and content hashes of the audio files
+AUDIO_INDEX = os.path.join(
+    DATASET_BASE_DIRS["LocalTemporary_Dataset"], "audio-index.jsonl"
+)
@@ -6,22 +6,53 @@ from collections import defaultdict
 
 # preprocess transforms
 SSM_USING_MELODY = True
+# sparse k-NN similarity matrices, for long recordings (live sets, DJ mixes)
+SSM_SPARSE = False  # experimental, see the README
 MEL_TRANSFORM_IDENTIFIER = 8
 SSM_TRANSFORM_IDENTIFIER = (
-    11 if not SSM_USING_MELODY else 12
-)  # <without-melody>:11 <with-melody>:12 <melody-only>:13
-CLI_TRANSFORM_IDENTIFIER = 15 if not SSM_USING_MELODY else 14
+    (11 if not SSM_USING_MELODY else 12)
+    if not SSM_SPARSE
+    else (17 if not SSM_USING_MELODY else 16)
+)  # <without-melody>:11 <with-melody>:12 <melody-only>:13 <sparse>:17/16
+CLI_TRANSFORM_IDENTIFIER = (
+    (15 if not SSM_USING_MELODY else 14)
+    if not SSM_SPARSE
+    else (19 if not SSM_USING_MELODY else 18)
+)
 
 # similarity fusion settings
 REC_SMOOTH = 9
+FUSION_DTYPE = np.float64  # np.float32 halves the memory traffic of the fusion
+# shift-invariant chroma distances as one FFT cross-correlation instead of a loop over
+# the shifts, faster but computed in float64 while the loop keeps the float32 of the
+# features: the distances differ by ~1e-6, the fused ssm by up to a few percent
+SSM_FFT_CHROMA = False
 EPSILON = 1e-9
 SAMPLE_RATE = 22050
+MEL_SAMPLE_RATE = 8000  # input sample rate of the melody extractors (SSL/JDC)
 SSM_TIME_STEP = 1 / SAMPLE_RATE * 512 * 10  # GraphDitty hop=512, win_fac=10
 SSM_FEATURES = {
     11: ["Fused"],
     12: ["Fused"],
     13: ["Melody"],
+    16: ["Fused"],
+    17: ["Fused"],
 }[SSM_TRANSFORM_IDENTIFIER]
+# sparse mode: pattern of the affinity matrices
+SSM_SPARSE_NEIGHBORS = 30  # nearest neighbors kept for each frame
+SSM_SPARSE_BAND = 10  # diagonals kept on each side of the main diagonal
+SSM_SPARSE_REACH = 30  # 2-hop candidates added for each frame before the clique step
+# reduce the stacked mfcc/tempogram features before the distances, None disables it
+# the cached ssm features must be rebuilt after changing these
+SSM_REDUCE_DIM = None  # e.g. 128
+SSM_REDUCE_METHOD = "projection"  # "projection"(sparse random projection) or "pca"
+SSM_REDUCE_SEED = 42
+# stored log ssm: dtype (np.float16/np.float32 shrink the cache), zlib compression
+# (not memory-mapped then), and the largest absolute error a lossy dtype may add,
+# a higher precision is stored otherwise
+SSM_STORE_DTYPE = np.float64
+SSM_STORE_COMPRESS = False
+SSM_STORE_TOLERANCE = 1e-2
 
 # pitch chroma feature
 PITCH_CHROMA_CLASS = 12
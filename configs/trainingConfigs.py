@@ -1,4 +1,5 @@
 from collections import defaultdict
+from functools import lru_cache
 
 from utility.dataset import (
     RWC_Popular_Dataset,
@@ -7,24 +8,48 @@ from utility.dataset import (
     CCM_Dataset,
     Huawei_Dataset,
 )
+from utility.common import LazyRegistry
 from configs.modelConfigs import SSM_TRANSFORM_IDENTIFIER, USE_DATASET_NAME
 
-DATASET_DIC = {
-    "RWC_Popular_Dataset": RWC_Popular_Dataset(),
-    "RWC_Popular_Dataset_accomp": RWC_Popular_Dataset_accomp(),
-    "CCM_Dataset": CCM_Dataset(),
-    "Huawei_Dataset": Huawei_Dataset(),
-}
-USING_DATASET = DATASET_DIC[USE_DATASET_NAME]
+# datasets are built (directories listed, GT files parsed) when first selected
+DATASET_DIC = LazyRegistry(
+    {
+        "RWC_Popular_Dataset": RWC_Popular_Dataset,
+        "RWC_Popular_Dataset_accomp": RWC_Popular_Dataset_accomp,
+        "CCM_Dataset": CCM_Dataset,
+        "Huawei_Dataset": Huawei_Dataset,
+    }
+)
+USING_DATASET_CLASS = DATASET_DIC.factories[USE_DATASET_NAME]
 
 # ssm target generation (label index)
 CLF_SPLIT_RATIO = 0.8
 RANDOM_SEED = 114514
-CLF_TRAIN_SET, CLF_VAL_SET = USING_DATASET.randomSplit(
-    CLF_SPLIT_RATIO, seed=RANDOM_SEED
-)
+
+
+def usingDataset():
+    return DATASET_DIC[USE_DATASET_NAME]
+
+
+@lru_cache(maxsize=None)
+def clfSplit():
+    # train and validation views of the using dataset
+    return usingDataset().randomSplit(CLF_SPLIT_RATIO, seed=RANDOM_SEED)
+
+
+def __getattr__(name):
+    # USING_DATASET, CLF_TRAIN_SET and CLF_VAL_SET are built on their first use
+    if name == "USING_DATASET":
+        return usingDataset()
+    if name == "CLF_TRAIN_SET":
+        return clfSplit()[0]
+    if name == "CLF_VAL_SET":
+        return clfSplit()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 CHORUS_CLASSIFIER_TRAIN_DATA_FILE = {
-    algo: f"data/models/{USING_DATASET.__class__.__name__}_{algo}_TRAIN.pkl"
+    algo: f"data/models/{USING_DATASET_CLASS.__name__}_{algo}_TRAIN.pkl"
     for algo in [
         "scluster",
         "cnmf",
@@ -36,7 +61,7 @@ CHORUS_CLASSIFIER_TRAIN_DATA_FILE = {
 }
 CHORUS_CLASSIFIER_TRAIN_DATA_FILE[
     "seqRecur"
-] = f"data/models/{USING_DATASET.__class__.__name__}_tf{SSM_TRANSFORM_IDENTIFIER}_seqRecur_TRAIN.pkl"
+] = f"data/models/{USING_DATASET_CLASS.__name__}_tf{SSM_TRANSFORM_IDENTIFIER}_seqRecur_TRAIN.pkl"
 
 CHORUS_CLASSIFIER_VAL_DATA_FILE = {
     key: val.replace("TRAIN.pkl", "VAL.pkl")
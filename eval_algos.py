@@ -2,12 +2,6 @@ import click
 import numpy as np
 import pandas as pd
 
-from utility.dataset import (
-    RWC_Popular_Dataset,
-    CCM_Dataset,
-    RWC_Popular_Dataset_accomp,
-    Huawei_Dataset,
-)
 from utility.algorithmsWrapper import (
     AlgoSeqRecur,
     AlgoSeqRecurBound,
@@ -21,11 +15,16 @@ from utility.algorithmsWrapper import (
     AlgoMixed,
 )
 from utility.metrics import AlgoEvaluator, Metrics_Saver
-from configs.configs import EVAL_RESULT_DIR, FORCE_EVAL, METRIC_NAMES, logger
+from utility.common import LazyRegistry
+from configs.configs import (
+    EVAL_RESULT_DIR,
+    FORCE_EVAL,
+    METRIC_NAMES,
+    logger,
+    makeDirs,
+)
+from configs.modelConfigs import SSM_SPARSE, USE_DATASET_NAME
 from configs.trainingConfigs import (
-    CLF_VAL_SET,
-    CLF_TRAIN_SET,
-    USING_DATASET,
     CLF_SPLIT_RATIO,
     RANDOM_SEED,
     CHORUS_CLASSIFIER_TRAIN_DATA_FILE,
@@ -34,25 +33,33 @@ from configs.trainingConfigs import (
 
 
 trainData = CHORUS_CLASSIFIER_TRAIN_DATA_FILE
-algos = {
-    "seqRecur": AlgoSeqRecur(trainData["seqRecur"]),
-    "seqRecur+": AlgoSeqRecurBound(trainData["seqRecur"]),
-    "seqRecurS": AlgoSeqRecurSingle(trainData["seqRecur"]),
-    "highlighter": PopMusicHighlighter(),
-    "refraiD": RefraiD(),
-    "scluster": MsafAlgos("scluster", trainData["scluster"]),
-    "sf": MsafAlgosBdryOnly("sf", trainData["sf"]),
-    "olda": MsafAlgosBdryOnly("olda", trainData["olda"]),
-    "foote": MsafAlgosBdryOnly("foote", trainData["foote"]),
-    "cnmf": MsafAlgos("cnmf", trainData["cnmf"]),
-    "scluster+": MsafAlgosBound("scluster"),
-    "sf+": MsafAlgosBound("sf"),
-    "olda+": MsafAlgosBound("olda"),
-    "cnmf+": MsafAlgosBound("cnmf"),
-    "foote+": MsafAlgosBound("foote"),
-    "gtBoundary": GroudTruthStructure(trainData["gtBoundary"]),
-    "mixed": AlgoMixed(trainData["seqRecur"]),
+# algorithms are built when selected, e.g. the highlighter may set up its venv
+algoFactories = {
+    "seqRecur": lambda: AlgoSeqRecur(trainData["seqRecur"]),
+    "seqRecur+": lambda: AlgoSeqRecurBound(trainData["seqRecur"]),
+    "seqRecurS": lambda: AlgoSeqRecurSingle(trainData["seqRecur"]),
+    "highlighter": PopMusicHighlighter,
+    "refraiD": RefraiD,
+    "scluster": lambda: MsafAlgos("scluster", trainData["scluster"]),
+    "sf": lambda: MsafAlgosBdryOnly("sf", trainData["sf"]),
+    "olda": lambda: MsafAlgosBdryOnly("olda", trainData["olda"]),
+    "foote": lambda: MsafAlgosBdryOnly("foote", trainData["foote"]),
+    "cnmf": lambda: MsafAlgos("cnmf", trainData["cnmf"]),
+    "scluster+": lambda: MsafAlgosBound("scluster"),
+    "sf+": lambda: MsafAlgosBound("sf"),
+    "olda+": lambda: MsafAlgosBound("olda"),
+    "cnmf+": lambda: MsafAlgosBound("cnmf"),
+    "foote+": lambda: MsafAlgosBound("foote"),
+    "gtBoundary": lambda: GroudTruthStructure(trainData["gtBoundary"]),
+    "mixed": lambda: AlgoMixed(trainData["seqRecur"]),
 }
+if SSM_SPARSE:
+    # keep the sparse mode results apart from the dense ones in the same csv
+    algoFactories = {
+        (name + "-sparse" if name.startswith("seqRecur") else name): factory
+        for name, factory in algoFactories.items()
+    }
+algos = LazyRegistry(algoFactories)
 algo_order = [
     "seqRecur",
     "seqRecurS",
@@ -65,6 +72,8 @@ algo_order = [
     "foote",
     "gtBoundary",
 ]
+if SSM_SPARSE:
+    algo_order[2:2] = ["seqRecur-sparse", "seqRecurS-sparse"]
 # algo_order += [
 #     "seqRecur+",
 #     "olda+",
@@ -94,30 +103,19 @@ def updateViews(evalAlgos, dName):
         "_TRAIN": train,
     }
     for vName, vLoader in loader_views.items():
-        for dName, dLoader in DATASET_DIC.items():
-            if vLoader.__class__ is dLoader.__class__:
-                name = dName + vName
-                logger.info(
-                    "----------------------------------------------------------"
-                )
-                logger.info(f"loader view, name={name}")
-                viewSaver = Metrics_Saver(name)
-                dSaver = Metrics_Saver(dName)
-                dSaver.load(EVAL_RESULT_DIR)
-                for aName in dSaver.algoNames:
-                    titles = [pp.title for pp in vLoader.pathPairs]
-                    metrics, _ = dSaver.getResult(aName, titles)
-                    viewSaver.addResult(aName, metrics, titles)
-                    if aName in evalAlgos:
-                        printResult(aName, metrics)
-                dumpResult(viewSaver)
-
-
-def findLoader(clz):
-    for dName, dLoader in DATASET_DIC.items():
-        if clz is dLoader.__class__:
-            return {dName: dLoader}
-    raise KeyError
+        name = dName + vName
+        logger.info("----------------------------------------------------------")
+        logger.info(f"loader view, name={name}")
+        viewSaver = Metrics_Saver(name)
+        dSaver = Metrics_Saver(dName)
+        dSaver.load(EVAL_RESULT_DIR)
+        for aName in dSaver.algoNames:
+            titles = [pp.title for pp in vLoader.pathPairs]
+            metrics, _ = dSaver.getResult(aName, titles)
+            viewSaver.addResult(aName, metrics, titles)
+            if aName in evalAlgos:
+                printResult(aName, metrics)
+        dumpResult(viewSaver)
 
 
 @click.command()
@@ -131,16 +129,18 @@ def findLoader(clz):
     "--algorithm", default=None, type=click.STRING, help="using specific algorithm"
 )
 def main(force, dataset, algorithm):
+    makeDirs()
     if dataset is None:
         evalLoader = DATASET_DIC
     elif dataset == "auto":
-        evalLoader = findLoader(USING_DATASET.__class__)
+        evalLoader = {USE_DATASET_NAME: DATASET_DIC[USE_DATASET_NAME]}
     else:
         evalLoader = {dataset: DATASET_DIC[dataset]}
+    # names only, an algorithm is built when it is evaluated
     if algorithm is None:
-        evalAlgos = algos
+        evalAlgos = list(algos)
     else:
-        evalAlgos = {algorithm: algos[algorithm]}
+        evalAlgos = [algorithm]
 
     for dName, loader in evalLoader.items():
         logger.info("-----------------------eval_algos---------------------------")
@@ -148,7 +148,7 @@ def main(force, dataset, algorithm):
         saver = Metrics_Saver(dName)
         # run incremental evaluation by default
         saver.load(EVAL_RESULT_DIR)
-        for aName, algo in evalAlgos.items():
+        for aName in evalAlgos:
             # avoid duplicate evaluation
             if (aName not in saver.algoNames) or force:
                 if force and (aName in saver.algoNames):
@@ -156,6 +156,7 @@ def main(force, dataset, algorithm):
                 else:
                     logger.info(f"algo, name={aName}")
 
+                algo = algos[aName]
                 if hasattr(algo, "clf"):
                     algo.clf.train()
                 ae = AlgoEvaluator(loader, algo)
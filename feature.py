@@ -1,12 +1,12 @@
 import click
 import pickle
-from tqdm import tqdm
 import os
 import numpy as np
 import matplotlib.pyplot as plt
-from multiprocessing import Pool
+from functools import partial
 
-from utility.dataset import Preprocess_Dataset, buildPreprocessDataset
+from utility.dataset import Preprocess_Dataset, buildPipeline, buildPreprocessDataset
+from utility.parallel import scheduledMap
 from utility.transform import ExtractCliques, ExtractMel
 from utility.algorithmsWrapper import (
     AlgoSeqRecur,
@@ -14,25 +14,20 @@ from utility.algorithmsWrapper import (
     GroudTruthStructure,
     MsafAlgos,
     MsafAlgosBdryOnly,
+    compactCachedAlgos,
 )
 from models.classifier import GetAlgoData
-from configs.configs import NUM_WORKERS, logger
+from utility.common import LazyRegistry
+from configs.configs import logger, makeDirs
 from configs.trainingConfigs import (
     CHORUS_CLASSIFIER_TRAIN_DATA_FILE,
     CHORUS_CLASSIFIER_VAL_DATA_FILE,
-    CLF_TRAIN_SET,
-    CLF_VAL_SET,
-    USING_DATASET,
+    clfSplit,
+    usingDataset,
 )
 from models.classifier import ChorusClassifier
 
 
-def starGetCliqueClassData(t):
-    getData, baseset, idx = t
-    res = getData(baseset, idx)
-    return res
-
-
 def buildCCDataset(cpath, baseset, getData, force=True):
     if not os.path.exists(cpath) or force:
         X = []
@@ -40,17 +35,12 @@ def buildCCDataset(cpath, baseset, getData, force=True):
         logger.info(
             f"building clique class Data for <{baseset.__class__.__name__}> @ {cpath}"
         )
-        with Pool(NUM_WORKERS) as p:
-            N = len(baseset)
-            results = list(
-                tqdm(
-                    p.imap(
-                        starGetCliqueClassData,
-                        zip([getData] * N, [baseset] * N, range(N)),
-                    ),
-                    total=N,
-                )
-            )
+        # the workers hold the algorithm and the dataset, tasks are song indices
+        results = scheduledMap(
+            partial(getData, baseset),
+            [(i,) for i in range(len(baseset))],
+            weights=baseset.getWeights(),
+        )
         for features, clabels in results:
             X.extend([feature for feature in features])
             y.extend([clabel for clabel in clabels])
@@ -74,27 +64,31 @@ def testCCDataset(method):
         logger.info(f"test classifier on valid data, score={clf.score(Xt, yt):.3f}")
 
 
-# build Preprocess Dataset for feature extraction
-transforms = {
-    "extract-mel": ExtractMel(),
-    "generate-ssm": GenerateSSM(dataset=USING_DATASET),
-    "extract-cliques": ExtractCliques(dataset=USING_DATASET),
-}
+# build Preprocess Dataset for feature extraction, built when selected
+transforms = LazyRegistry(
+    {
+        "extract-mel": ExtractMel,
+        "generate-ssm": lambda: GenerateSSM(dataset=usingDataset()),
+        "extract-cliques": lambda: ExtractCliques(dataset=usingDataset()),
+    }
+)
 trainData = CHORUS_CLASSIFIER_TRAIN_DATA_FILE
-methods = {
-    "seqRecur": GetAlgoData(AlgoSeqRecur(trainData["seqRecur"])),
-    "scluster": GetAlgoData(MsafAlgos("scluster", trainData["scluster"])),
-    "cnmf": GetAlgoData(MsafAlgos("cnmf", trainData["cnmf"])),
-    "sf": GetAlgoData(MsafAlgosBdryOnly("sf", trainData["sf"])),
-    "olda": GetAlgoData(MsafAlgosBdryOnly("olda", trainData["olda"])),
-    "foote": GetAlgoData(MsafAlgosBdryOnly("foote", trainData["foote"])),
-    "gtBoundary": GetAlgoData(GroudTruthStructure(trainData["gtBoundary"])),
-}
+methods = LazyRegistry(
+    {
+        "seqRecur": lambda: GetAlgoData(AlgoSeqRecur(trainData["seqRecur"])),
+        "scluster": lambda: GetAlgoData(MsafAlgos("scluster", trainData["scluster"])),
+        "cnmf": lambda: GetAlgoData(MsafAlgos("cnmf", trainData["cnmf"])),
+        "sf": lambda: GetAlgoData(MsafAlgosBdryOnly("sf", trainData["sf"])),
+        "olda": lambda: GetAlgoData(MsafAlgosBdryOnly("olda", trainData["olda"])),
+        "foote": lambda: GetAlgoData(MsafAlgosBdryOnly("foote", trainData["foote"])),
+        "gtBoundary": lambda: GetAlgoData(GroudTruthStructure(trainData["gtBoundary"])),
+    }
+)
 
 
 @click.group()
 def cli():
-    pass
+    makeDirs()
 
 
 @click.command()
@@ -103,27 +97,44 @@ def cli():
 )
 @click.option("--force", nargs=1, type=click.BOOL, default=False)
 def build(transform, force):
-    buildTransforms = (
+    if transform is None:
+        # all the stages in one pipeline, no barrier between them
+        buildPipeline(usingDataset(), transforms.values(), force=force)
+    else:
+        buildPreprocessDataset(usingDataset(), transforms[transform], force=force)
+
+
+@click.command()
+@click.option(
+    "--transform", nargs=1, type=click.Choice(transforms.keys()), default=None
+)
+def compact(transform):
+    """reclaim the space of overwritten records in the shard stores, without
+    --transform the cached algorithm results are compacted too"""
+    compactTransforms = (
         transforms.values() if transform is None else [transforms[transform]]
     )
-
-    for tf in buildTransforms:
-        buildPreprocessDataset(USING_DATASET, tf, force=force)
+    for tf in compactTransforms:
+        Preprocess_Dataset(tf.identifier, usingDataset()).compact()
+    if transform is None:
+        compactCachedAlgos()
 
 
 @click.command()
 @click.option("--method", nargs=1, type=click.Choice(methods.keys()), default=None)
 def train(method):
     trainMethods = methods.items() if method is None else [(method, methods[method])]
+    trainSet, valSet = clfSplit()
     for name, getDataFun in trainMethods:
         cpath_train = CHORUS_CLASSIFIER_TRAIN_DATA_FILE[name]
         cpath_val = CHORUS_CLASSIFIER_VAL_DATA_FILE[name]
-        buildCCDataset(cpath_train, CLF_TRAIN_SET, getDataFun)
-        buildCCDataset(cpath_val, CLF_VAL_SET, getDataFun)
+        buildCCDataset(cpath_train, trainSet, getDataFun)
+        buildCCDataset(cpath_val, valSet, getDataFun)
         testCCDataset(name)
 
 
 cli.add_command(build)
 cli.add_command(train)
+cli.add_command(compact)
 if __name__ == "__main__":
     cli()
@@ -1,22 +1,41 @@
 import librosa
-import scipy
 import numpy as np
 from copy import deepcopy
+from scipy import sparse
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.decomposition import PCA
+from sklearn.random_projection import SparseRandomProjection
 
 from third_party.GraphDitty.CSMSSMTools import (
     getCSM,
     getCSMCosine,
+    getCSMKNN,
     getShiftInvariantCSM,
+    getShiftInvariantCSMCosine,
+)
+from third_party.GraphDitty.SimilarityFusion import (
+    doSimilarityFusionWs,
+    doSimilarityFusionWsSparse,
+    getW,
+    getWSparse,
 )
-from third_party.GraphDitty.SimilarityFusion import doSimilarityFusionWs, getW
 from utility.common import logSSM, printArray
 from configs.modelConfigs import (
+    FUSION_DTYPE,
     PITCH_CHROMA_CLASS,
     PITCH_CHROMA_HOP,
     PITCH_CHROMA_COUNT,
     REC_SMOOTH,
+    SSM_FFT_CHROMA,
+    SSM_SPARSE,
+    SSM_SPARSE_BAND,
+    SSM_SPARSE_NEIGHBORS,
+    SSM_REDUCE_DIM,
+    SSM_REDUCE_METHOD,
+    SSM_REDUCE_SEED,
 )
-from configs.configs import logger
+from configs.configs import SSM_THREADS, logger
 
 
 def selfSimilarityMatrix(
@@ -27,7 +46,14 @@ def selfSimilarityMatrix(
     K=5,
     sr=22050,
     hop_length=512,
+    use_sparse=SSM_SPARSE,
+    reduce_dim=SSM_REDUCE_DIM,
+    reduce_method=SSM_REDUCE_METHOD,
+    num_threads=SSM_THREADS,
 ):
+    """num_threads: threads for the independent per-modality branches, the cores
+    left by the branches go to the row blocks of the FFT chroma distances,
+    size it to the cores left to this process (1 runs them one after another)"""
     logger.debug(f"loading:{wavfile}")
     y, sr = librosa.load(wavfile, sr=sr)
     nHops = (y.size - hop_length * (win_fac - 1)) / hop_length
@@ -35,68 +61,88 @@ def selfSimilarityMatrix(
     logger.debug(
         f"nHops={nHops}=(size-hop_length*(win_fac-1))/hop_length=({y.size} - {hop_length}*({win_fac}-1))/{hop_length} intvs={intervals[-1]}"
     )
-    # chorma
-    chroma = librosa.feature.chroma_cqt(
-        y=y, sr=sr, hop_length=hop_length, bins_per_octave=12 * 3
-    )
-    # mfcc
-    S = librosa.feature.melspectrogram(y, sr=sr, n_mels=128, hop_length=hop_length)
-    log_S = librosa.power_to_db(S, ref=np.max)
-    mfcc = librosa.feature.mfcc(S=log_S, n_mfcc=20)
-    lifterexp = 0.6
-    coeffs = np.arange(mfcc.shape[0]) ** lifterexp
-    coeffs[0] = 1
-    mfcc = coeffs[:, None] * mfcc
-    # tempogram
-    SUPERFLUX_SIZE = 5
-    oenv = librosa.onset.onset_strength(
-        y=y, sr=sr, hop_length=hop_length, max_size=SUPERFLUX_SIZE
-    )
-    tempogram = librosa.feature.tempogram(
-        onset_envelope=oenv, sr=sr, hop_length=hop_length
-    )
+    with ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        # features
+        chromaJob = executor.submit(chromaFeature, y, sr, hop_length)
+        mfccJob = executor.submit(mfccFeature, y, sr, hop_length)
+        tempoJob = executor.submit(tempoFeature, y, sr, hop_length)
+        if mel is not None:
+            pitchJob = executor.submit(pitchChroma, mel[1])
+        chroma, mfcc, tempogram = (
+            chromaJob.result(),
+            mfccJob.result(),
+            tempoJob.result(),
+        )
 
-    # generate W- matrices
-    n_frames = np.min([chroma.shape[1], mfcc.shape[1], tempogram.shape[1]])
-    intervals = librosa.util.fix_frames(intervals, x_min=0, x_max=n_frames)
-    times = intervals * float(hop_length) / float(sr)
-    size = n_frames // win_fac
-    logger.debug(
-        f"frames fixed, intervals={intervals[-1]} hop={intervals[1]-intervals[0]} size={size}"
-    )
-    WMfcc = feature2W(mfcc, size, np.mean, getCSM, wins_per_block=wins_per_block)
-    WChroma = feature2W(
-        chroma,
-        size,
-        np.median,
-        getShiftInvariantCSM(getCSMCosine, wins_per_block),
-        wins_per_block=wins_per_block,
-    )
-    WTempo = feature2W(tempogram, size, np.mean, getCSM, wins_per_block=wins_per_block)
-    printArray(WMfcc, "mfcc")
-    printArray(WChroma, "chorma")
-    printArray(WTempo, "tempo")
+        # generate W- matrices
+        n_frames = np.min([chroma.shape[1], mfcc.shape[1], tempogram.shape[1]])
+        intervals = librosa.util.fix_frames(intervals, x_min=0, x_max=n_frames)
+        times = intervals * float(hop_length) / float(sr)
+        size = n_frames // win_fac
+        logger.debug(
+            f"frames fixed, intervals={intervals[-1]} hop={intervals[1]-intervals[0]} size={size}"
+        )
+        # the shift-invariant chroma distances rely on the stacked layout, only the
+        # euclidean ones are reduced
+        reduceArgs = {"reduce_dim": reduce_dim, "reduce_method": reduce_method}
+        if SSM_FFT_CHROMA:
+            csmWorkers = max(1, num_threads // (3 if mel is None else 4))
+            chromaCSM = getShiftInvariantCSMCosine(
+                wins_per_block, num_workers=csmWorkers
+            )
+        else:
+            chromaCSM = getShiftInvariantCSM(getCSMCosine, wins_per_block)
+        branches = {
+            "mfcc": (mfcc, np.mean, getCSM, reduceArgs),
+            "chorma": (
+                chroma,
+                np.median,
+                chromaCSM,
+                {},
+            ),
+            "tempo": (tempogram, np.mean, getCSM, reduceArgs),
+        }
+        if mel is not None:
+            branches["pitchChroma"] = (
+                pitchJob.result(),
+                np.median,
+                chromaCSM,
+                {},
+            )
+        jobs = {
+            name: executor.submit(
+                feature2W,
+                feature,
+                size,
+                aggregator,
+                simFunction,
+                wins_per_block=wins_per_block,
+                use_sparse=use_sparse,
+                **kwargs,
+            )
+            for name, (feature, aggregator, simFunction, kwargs) in branches.items()
+        }
+        WDic = {name: job.result() for name, job in jobs.items()}
+    for name, W in WDic.items():
+        printArray(W, name)
 
     # melody
     if mel is not None:
-        _, pitches = mel
-        pitches = pitchChroma(pitches)
-        WPitches = feature2W(
-            pitches,
-            size,
-            np.median,
-            getShiftInvariantCSM(getCSMCosine, wins_per_block),
-            wins_per_block=wins_per_block,
-        )
-        printArray(WPitches, "pitchChroma")
-        Ws = [WMfcc, WChroma, WPitches, WTempo]
+        WPitches = WDic["pitchChroma"]
+        Ws = [WDic["mfcc"], WDic["chorma"], WPitches, WDic["tempo"]]
     else:
-        Ws = [WMfcc, WChroma, WTempo]
+        Ws = [WDic["mfcc"], WDic["chorma"], WDic["tempo"]]
 
-    if REC_SMOOTH > 0:
-        df = librosa.segment.timelag_filter(scipy.ndimage.median_filter)
-        Ws = [df(W, size=(1, REC_SMOOTH)) for W in Ws]
-    W = doSimilarityFusionWs(Ws, K=K, niters=3, reg_diag=1.0, reg_neighbs=0.5)
+    if use_sparse:
+        if REC_SMOOTH > 0:
+            Ws = [lagMedianFilterSparse(W, REC_SMOOTH) for W in Ws]
+        W = doSimilarityFusionWsSparse(Ws, K=K, niters=3, reg_diag=1.0, reg_neighbs=0.5)
+    else:
+        if REC_SMOOTH > 0:
+            Ws = list(lagMedianFilter(Ws, REC_SMOOTH))
+        W = doSimilarityFusionWs(
+            Ws, K=K, niters=3, reg_diag=1.0, reg_neighbs=0.5, dtype=FUSION_DTYPE
+        )
     printArray(W, "fused W")
     res = {
         "Ws": {
@@ -113,6 +159,7 @@ def pitchChroma(
     n_class=PITCH_CHROMA_CLASS,
     count=PITCH_CHROMA_COUNT,
     hop=PITCH_CHROMA_HOP,
+    batched=True,
 ):
     """input: [frames]
     output: [n_class, frames]"""
@@ -124,10 +171,12 @@ def pitchChroma(
     pitches = np.remainder(pitches.astype(int), n_class)
     # -1 represnets non-voice, will be ignored in bincount
     pitches[nonVoice] = n_class
+    assert (pitches <= n_class).all()
+    if batched:
+        return weightedPitchHistogram(pitches, n_class, count, hop)
+
     # pitches: [1, frames]
     pitches = np.expand_dims(pitches, axis=0)
-
-    assert (pitches <= n_class).all()
     # XPitches: [count, frames]
     XPitches = librosa.feature.stack_memory(
         pitches, n_steps=count, delay=hop, mode="edge"
@@ -143,6 +192,141 @@ def pitchChroma(
     return res
 
 
+def weightedPitchHistogram(pitchClasses, n_class, count, hop):
+    """histograms of the past <count> frames (every <hop> frames) weighted by <count - i>,
+    same as bincount over `stack_memory(mode="edge")` without building the stacked matrix
+    input: [frames] (n_class represents non-voice)
+    output: [n_class, frames]"""
+    frames = pitchClasses.shape[-1]
+    # edge padding, then pad the tail so the frames split into <hop> chains
+    pad = (count - 1) * hop
+    tail = -(pad + frames) % hop
+    classes = np.concatenate(
+        [np.full(pad, pitchClasses[0]), pitchClasses, np.full(tail, n_class)]
+    )
+    # onehot[<n_class>, <steps>, <hop>], frame j=step*hop+r
+    onehot = classes[None, :] == np.arange(n_class)[:, None]
+    onehot = onehot.reshape(n_class, -1, hop).astype(np.int64)
+    steps = np.arange(onehot.shape[1])[None, :, None]
+
+    # windowed sums by running sums along each chain:
+    # sum_i (count - i) * x[s - i] = (count - s) * sum_m x[m] + sum_m m * x[m]
+    def windowSum(x):
+        csum = np.cumsum(x, axis=1)
+        csum[:, count:] -= csum[:, :-count].copy()
+        return csum
+
+    res = (count - steps) * windowSum(onehot) + windowSum(steps * onehot)
+    res = res.reshape(n_class, -1)[:, pad : pad + frames]
+    return res.astype(float)
+
+
+def reduceDimension(X, n_components, method="projection", seed=SSM_REDUCE_SEED):
+    """fitted per song, seeded so the features are reproducible
+    input: [samples, dims]
+    output: [samples, n_components]"""
+    if method == "projection":
+        # approximately preserves the euclidean distances (Johnson-Lindenstrauss)
+        reducer = SparseRandomProjection(
+            n_components=n_components, dense_output=True, random_state=seed
+        )
+    elif method == "pca":
+        n_components = min(n_components, *X.shape)
+        reducer = PCA(n_components=n_components, random_state=seed)
+    else:
+        raise ValueError(f"unknown reduce method:{method}")
+    return reducer.fit_transform(X)
+
+
+def lagMedianFilter(Ws, size, blockSize=None):
+    """median filter of <size> frames along the time axis of the lag matrices,
+    same as `timelag_filter(median_filter)(W, size=(1, size))` for every W, but the
+    lag conversion is shared and only the lags mapped back to the recurrence are kept
+    input: list of [n, n], output: [<W number>, n, n]"""
+    Ws = np.asarray(Ws)
+    m, n, _ = Ws.shape
+    # window position of median_filter, reflect mode at the borders
+    left = size // 2
+    right = size - 1 - left
+    if blockSize is None:
+        blockSize = max(1, 2**22 // (m * n * size))
+    res = np.empty_like(Ws)
+    times = np.arange(n)
+    for start in range(0, 2 * n, blockSize):
+        # zero padded lag matrix: lag[l, t] = W[(l + t) % 2n, t] or 0 if beyond n
+        lags = np.arange(start, min(start + blockSize, 2 * n))
+        rows = (lags[:, None] + times[None, :]) % (2 * n)
+        valid = rows < n
+        if not valid.any():
+            continue
+        lag = Ws[:, np.minimum(rows, n - 1), times]
+        lag[:, ~valid] = 0
+        padded = np.pad(lag, ((0, 0), (0, 0), (left, right)), mode="symmetric")
+        windows = sliding_window_view(padded, size, axis=-1)[:, valid]
+        med = np.partition(windows, left, axis=-1)[..., left]
+        res[:, rows[valid], np.broadcast_to(times, rows.shape)[valid]] = med
+    return res
+
+
+def lagMedianFilterSparse(W, size):
+    """same as lagMedianFilter for a sparse matrix, the missing entries count as 0
+    every entry whose window along its diagonal holds a stored entry is evaluated
+    input: [n, n] scipy.sparse, output: [n, n] scipy.sparse.csr_matrix"""
+    W = sparse.coo_matrix(W)
+    n = W.shape[0]
+    left = size // 2
+    right = size - 1 - left
+    keys = W.row.astype(np.int64) * n + W.col
+    order = np.argsort(keys)
+    keys, data = keys[order], W.data[order]
+    # entries having a stored entry at offset t of their window
+    shifts = np.arange(-left, right + 1)
+    rows = (W.row[None, :] - shifts[:, None]).ravel()
+    cols = (W.col[None, :] - shifts[:, None]).ravel()
+    inside = (rows >= 0) & (rows < n) & (cols >= 0) & (cols < n)
+    candidates = np.unique(rows[inside].astype(np.int64) * n + cols[inside])
+    rows, cols = candidates // n, candidates % n
+    diag = rows - cols
+    windows = np.zeros((len(candidates), size), dtype=W.dtype)
+    for k, t in enumerate(shifts):
+        # symmetric padding along the time (column) axis of the lag matrix
+        c = (cols + t) % (2 * n)
+        c = np.where(c >= n, 2 * n - c - 1, c)
+        r = diag + c
+        valid = (r >= 0) & (r < n)
+        query = r[valid] * n + c[valid]
+        pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        found = keys[pos] == query
+        windows[np.flatnonzero(valid)[found], k] = data[pos[found]]
+    med = np.partition(windows, left, axis=1)[:, left]
+    keep = med != 0
+    return sparse.csr_matrix((med[keep], (rows[keep], cols[keep])), shape=(n, n))
+
+
+def chromaFeature(y, sr, hop_length):
+    return librosa.feature.chroma_cqt(
+        y=y, sr=sr, hop_length=hop_length, bins_per_octave=12 * 3
+    )
+
+
+def mfccFeature(y, sr, hop_length):
+    S = librosa.feature.melspectrogram(y=y, sr=sr, n_mels=128, hop_length=hop_length)
+    log_S = librosa.power_to_db(S, ref=np.max)
+    mfcc = librosa.feature.mfcc(S=log_S, n_mfcc=20)
+    lifterexp = 0.6
+    coeffs = np.arange(mfcc.shape[0]) ** lifterexp
+    coeffs[0] = 1
+    return coeffs[:, None] * mfcc
+
+
+def tempoFeature(y, sr, hop_length):
+    SUPERFLUX_SIZE = 5
+    oenv = librosa.onset.onset_strength(
+        y=y, sr=sr, hop_length=hop_length, max_size=SUPERFLUX_SIZE
+    )
+    return librosa.feature.tempogram(onset_envelope=oenv, sr=sr, hop_length=hop_length)
+
+
 def resize(feature, size):
     # feature[<dim>, <frames>]
     length = feature.shape[-1]
@@ -152,7 +336,17 @@ def resize(feature, size):
     return intervals
 
 
-def feature2W(feature, size, aggregator, simFunction, wins_per_block=20, K=5):
+def feature2W(
+    feature,
+    size,
+    aggregator,
+    simFunction,
+    wins_per_block=20,
+    K=5,
+    use_sparse=False,
+    reduce_dim=None,
+    reduce_method="projection",
+):
     intervals = resize(feature, size)
     # feature[<dim>, <frame>] -> [<dim>, <interval number>], intervals=frames//(size-1)
     feature = librosa.util.sync(feature, intervals, aggregate=aggregator)
@@ -160,10 +354,20 @@ def feature2W(feature, size, aggregator, simFunction, wins_per_block=20, K=5):
     Xfeature = librosa.feature.stack_memory(
         feature, n_steps=wins_per_block, mode="edge"
     ).T
-    Dfeature = simFunction(Xfeature, Xfeature)
-    # Wfeature[<interval number>, <interval number>]
-    Wfeature = getW(Dfeature, K)
-    assert not np.isnan(np.sum(Wfeature)), f"invalid affinity, Dfeature={Dfeature}"
+    if reduce_dim is not None and Xfeature.shape[1] > reduce_dim:
+        Xfeature = reduceDimension(Xfeature, reduce_dim, method=reduce_method)
+    if use_sparse:
+        # only the nearest neighbors and a temporal band are kept
+        Dfeature = getCSMKNN(
+            Xfeature, simFunction, SSM_SPARSE_NEIGHBORS, SSM_SPARSE_BAND
+        )
+        Wfeature = getWSparse(Dfeature, K)
+        assert not np.isnan(np.sum(Wfeature.data)), "invalid affinity"
+    else:
+        Dfeature = simFunction(Xfeature, Xfeature)
+        # Wfeature[<interval number>, <interval number>]
+        Wfeature = getW(Dfeature, K)
+        assert not np.isnan(np.sum(Wfeature)), f"invalid affinity, Dfeature={Dfeature}"
     logger.debug(
         f"shapes, feature{feature.shape} Xfeature{Xfeature.shape} Wfeature{Wfeature.shape}"
     )
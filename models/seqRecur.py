@@ -2,7 +2,7 @@ import logging
 import numpy as np
 from copy import copy, deepcopy
 from collections import defaultdict
-from scipy.stats import mode
+from scipy import sparse
 from scipy.sparse.csgraph import floyd_warshall
 from sklearn.cluster import AffinityPropagation
 import matplotlib.pyplot as plt
@@ -18,21 +18,29 @@ from configs.modelConfigs import (
     MIN_STRUCTURE_COUNT,
     SMOOTH_KERNEL_SIZE,
     SMOOTH_KERNEL_SIZE_RANGE,
+    SSM_SPARSE_REACH,
 )
 from configs.configs import DEBUG, logger
 
-
 affinityPropagation = AffinityPropagation()
 
 
 def modefilt(arr, kernel_size):
+    """sliding mode of the labels, windows are cut at the edges and ties go to
+    the smallest label (as scipy.stats.mode)"""
     dt = (kernel_size - 1) // 2
-    newarr = np.zeros_like(arr, dtype=int)
-    for i in range(len(arr)):
-        window = arr[max(0, i - dt) : min(len(arr), i + dt + 1)]
-        m, _ = mode(window)
-        newarr[i] = m[0]
-    return newarr
+    if len(arr) == 0:
+        return np.zeros_like(arr, dtype=int)
+    labels, codes = np.unique(arr, return_inverse=True)
+    # running label histograms: counts[i] - counts[j] is the histogram of arr[j:i]
+    counts = np.zeros((len(arr) + 1, len(labels)), dtype=np.int32)
+    counts[np.arange(1, len(arr) + 1), codes.reshape(-1)] = 1
+    np.cumsum(counts, axis=0, out=counts)
+    idx = np.arange(len(arr))
+    lower = np.maximum(0, idx - dt)
+    higher = np.minimum(len(arr), idx + dt + 1)
+    window = counts[higher] - counts[lower]
+    return labels[np.argmax(window, axis=1)].astype(int)
 
 
 def smoothCliques(cliques, size, kernel_size=SMOOTH_KERNEL_SIZE):
@@ -88,7 +96,139 @@ def smoothCliques(cliques, size, kernel_size=SMOOTH_KERNEL_SIZE):
 #     return cliques
 
 
+def sparseAffinityPropagation(
+    ssm, preference=None, damping=0.5, max_iter=200, convergence_iter=15
+):
+    """affinity propagation with messages passed along the stored entries of a sparse
+    similarity matrix only, the preference defaults to the median similarity"""
+    ssm = sparse.coo_matrix(ssm)
+    size = ssm.shape[0]
+    offDiag = ssm.row != ssm.col
+    if preference is None:
+        preference = np.median(ssm.data[offDiag])
+    # edges sorted by row, the diagonal always present
+    rows = np.concatenate([ssm.row[offDiag], np.arange(size)])
+    cols = np.concatenate([ssm.col[offDiag], np.arange(size)])
+    S = np.concatenate([ssm.data[offDiag], np.full(size, preference)])
+    order = np.lexsort((cols, rows))
+    rows, cols, S = rows[order], cols[order], S[order]
+    starts = np.searchsorted(rows, np.arange(size))
+    diag = np.flatnonzero(rows == cols)
+    # remove degeneracies
+    S = S + 1e-12 * (np.abs(S) + 1e-300) * np.random.RandomState(0).randn(len(S))
+
+    R = np.zeros_like(S)
+    A = np.zeros_like(S)
+    e = np.zeros((size, convergence_iter))
+    for it in range(max_iter):
+        # responsibility
+        AS = A + S
+        first = np.maximum.reduceat(AS, starts)
+        firstIdx = np.flatnonzero(AS == first[rows])
+        _, keep = np.unique(rows[firstIdx], return_index=True)
+        firstIdx = firstIdx[keep]
+        AS[firstIdx] = -np.inf
+        second = np.maximum.reduceat(AS, starts)
+        Rnew = S - first[rows]
+        Rnew[firstIdx] = S[firstIdx] - second
+        R = damping * R + (1 - damping) * Rnew
+        # availability
+        Rp = np.maximum(R, 0)
+        Rp[diag] = R[diag]
+        colSum = np.bincount(cols, weights=Rp, minlength=size)
+        Anew = colSum[cols] - Rp
+        dA = Anew[diag].copy()
+        Anew = np.minimum(Anew, 0)
+        Anew[diag] = dA
+        A = damping * A + (1 - damping) * Anew
+        # check for convergence
+        E = (A[diag] + R[diag]) > 0
+        e[:, it % convergence_iter] = E
+        K = np.sum(E)
+        if it >= convergence_iter:
+            se = np.sum(e, axis=1)
+            unconverged = np.sum((se == convergence_iter) + (se == 0)) != size
+            if not unconverged and K > 0:
+                break
+
+    exemplars = np.flatnonzero(E)
+    if len(exemplars) == 0:
+        logger.warn(f"sparse affinity propagation did not converge, size={size}")
+        return np.zeros(size, dtype=int)
+    # assign each frame to its most similar neighboring exemplar
+    isExemplar = np.zeros(size, dtype=bool)
+    isExemplar[exemplars] = True
+    labels = np.arange(size)
+    candidates = np.flatnonzero(isExemplar[cols])
+    Sc = S[candidates]
+    order = np.lexsort((-Sc, rows[candidates]))
+    candidates = candidates[order]
+    _, keep = np.unique(rows[candidates], return_index=True)
+    labels[rows[candidates[keep]]] = cols[candidates[keep]]
+    labels[exemplars] = exemplars
+    return labels
+
+
+def exemplarReach(ssm, reach=SSM_SPARSE_REACH, block_rows=256):
+    """2-hop entries of a sparse log ssm, max over k of ssm[i,k]+ssm[k,j], the best
+    <reach> of each row are kept where both rows agree (symmetric pattern)"""
+    ssm = sparse.csr_matrix(ssm)
+    ssm.sort_indices()
+    size = ssm.shape[0]
+    degree = np.diff(ssm.indptr)
+    rows, cols, vals = [], [], []
+    for lower in range(0, size, block_rows):
+        higher = min(size, lower + block_rows)
+        # first hops i->k of the block, then every second hop k->j
+        first = np.arange(ssm.indptr[lower], ssm.indptr[higher])
+        i = np.repeat(np.arange(lower, higher), degree[lower:higher])
+        k = ssm.indices[first]
+        count = degree[k]
+        hop = np.repeat(np.arange(len(first)), count)
+        second = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        second += np.repeat(ssm.indptr[k], count)
+        key = i[hop].astype(np.int64) * size + ssm.indices[second]
+        val = ssm.data[first][hop] + ssm.data[second]
+        # best path of each pair, without the stored entries and the diagonal
+        order = np.lexsort((-val, key))
+        key, val = key[order], val[order]
+        best = np.ones(len(key), dtype=bool)
+        best[1:] = key[1:] != key[:-1]
+        key, val = key[best], val[best]
+        stored = i.astype(np.int64) * size + k
+        keep = ~np.isin(key, stored) & (key // size != key % size)
+        key, val = key[keep], val[keep]
+        # top <reach> of each row
+        row = key // size
+        order = np.lexsort((-val, row))
+        key, val, row = key[order], val[order], row[order]
+        rank = np.arange(len(row)) - np.searchsorted(row, row)
+        rows.append(row[rank < reach])
+        cols.append(key[rank < reach] % size)
+        vals.append(val[rank < reach])
+    rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    # mutual candidates only, the larger value of both directions
+    if len(rows) == 0:
+        return sparse.csr_matrix(ssm.shape)
+    key = rows * size + cols
+    order = np.argsort(key)
+    key, rows, cols, vals = key[order], rows[order], cols[order], vals[order]
+    pos = np.minimum(np.searchsorted(key, cols * size + rows), len(key) - 1)
+    mutual = key[pos] == cols * size + rows
+    vals = np.maximum(vals, vals[pos])
+    return sparse.csr_matrix(
+        (vals[mutual], (rows[mutual], cols[mutual])), shape=ssm.shape
+    )
+
+
 def cliquesFromSSM(ssm_f, show=False):
+    if sparse.issparse(ssm_f[1]):
+        # missing entries of the sparse ssm have no affinity, exemplars can also
+        # be reached over 2 hops of the k-NN graph, the lowest similarity as the
+        # preference avoids over-segmenting it
+        ssm = (ssm_f[1] + exemplarReach(ssm_f[1])).tocsr()
+        labels = sparseAffinityPropagation(ssm, preference=np.min(ssm.data))
+        return cliquesFromArr(labels)
     # affinity propagation
     ssm = ssm_f[1] - np.max(ssm_f[1])
     median = np.median(ssm)
@@ -110,29 +250,45 @@ def cliquesFromSSM(ssm_f, show=False):
     return cliques
 
 
-def isAdjacent(cliqueA, cliqueB, dis=ADJACENT_DELTA_DISTANCE, dblock=0):
-    _, x = filteredCliqueEnds(cliqueA)
-    y, _ = filteredCliqueEnds(cliqueB)
-    deltaX2y = np.array([np.min(np.abs(y - i)) for i in x])
-    deltaY2x = np.array([np.min(np.abs(x - i)) for i in y])
+def cliqueDistances(cliques):
+    """{(i, j): (deltaX2y, deltaY2x)} for i < j, distances from the tails of clique i
+    to the heads of clique j and back, shared by every dis and dblock"""
+    ends = [filteredCliqueEnds(clique) for clique in cliques]
+    distances = {}
+    for i in range(len(cliques)):
+        _, x = ends[i]
+        for j in range(i + 1, len(cliques)):
+            y, _ = ends[j]
+            delta = np.abs(x[:, None] - y[None, :])
+            distances[i, j] = np.min(delta, axis=1), np.min(delta, axis=0)
+    return distances
 
+
+def adjacent(deltas, dis=ADJACENT_DELTA_DISTANCE, dblock=0):
+    deltaX2y, deltaY2x = deltas
     neighborX = np.sum(deltaX2y <= dis)
     neighborY = np.sum(deltaY2x <= dis)
     res = all(
         [
             neighborX > 0,
             neighborY > 0,
-            len(y) - neighborY <= dblock,
-            len(x) - neighborX <= dblock,
+            len(deltaY2x) - neighborY <= dblock,
+            len(deltaX2y) - neighborX <= dblock,
         ]
     )
     return res
 
 
-def error(origCliques, mergedCliques, size, times, show=False):
-    olssm = getLabeledSSM(origCliques, size)
+def isAdjacent(cliqueA, cliqueB, dis=ADJACENT_DELTA_DISTANCE, dblock=0):
+    return adjacent(cliqueDistances([cliqueA, cliqueB])[0, 1], dis=dis, dblock=dblock)
+
+
+def error(origCliques, mergedCliques, size, times, show=False, olssm=None):
+    # olssm: binary labeled ssm of origCliques, if computed once for several calls
+    if olssm is None:
+        olssm = getLabeledSSM(origCliques, size)
+        olssm[olssm > 0] = 1
     mlssm = getLabeledSSM(mergedCliques, size)
-    olssm[olssm > 0] = 1
     mlssm[mlssm > 0] = 1
     # false negative + false positive
     fnerr = np.sum((mlssm == 0) & olssm) / (np.sum(olssm) + EPSILON)
@@ -166,14 +322,18 @@ def mergeFind(adjLists, size):
     return labels
 
 
-def mergeAdjacentCliques(cliques, dis=ADJACENT_DELTA_DISTANCE, dblock=0):
+def mergeAdjacentCliques(
+    cliques, dis=ADJACENT_DELTA_DISTANCE, dblock=0, distances=None
+):
     logger.debug(f"merge cliques, dis={dis} dblock={dblock}")
+    if distances is None:
+        distances = cliqueDistances(cliques)
     size = len(cliques)
     adjLists = [[] for i in range(size)]  # i < j: adjLists[j] = [..., i, ...]
     # calculate adjacency matrix
     for i in range(size):
         for j in range(i + 1, size):
-            if isAdjacent(cliques[i], cliques[j], dis=dis, dblock=dblock):
+            if adjacent(distances[i, j], dis=dis, dblock=dblock):
                 adjLists[j].append(i)
     # merge cliques in transitive closure
     # key:smallest clique label in connected component
@@ -189,37 +349,33 @@ def mergeAdjacentCliques(cliques, dis=ADJACENT_DELTA_DISTANCE, dblock=0):
 
 
 def buildRecurrence(cliques, times):
+    """candidate of the (dis, kernel size, dblock) sweep with the lowest error and
+    at least MIN_STRUCTURE_COUNT cliques, every merge is shared by the kernel sizes"""
     logger.debug(f"build recurrence")
     cliques = deepcopy(cliques)
     size = len(times) - 1
-    mergedCliquesList = [
-        smoothCliques(
-            mergeAdjacentCliques(cliques, dis=dis, dblock=dblock),
-            size,
-            kernel_size=kernelSize,
-        )
-        for dis in DELTA_DIS_RANGE
-        for kernelSize in SMOOTH_KERNEL_SIZE_RANGE
-        for dblock in [0, 1, 2]
+    distances = cliqueDistances(cliques)
+    olssm = getLabeledSSM(cliques, size)
+    olssm[olssm > 0] = 1
+    merges = {}
+    mergedCliquesList = []
+    for dis in DELTA_DIS_RANGE:
+        for kernelSize in SMOOTH_KERNEL_SIZE_RANGE:
+            for dblock in [0, 1, 2]:
+                if (dis, dblock) not in merges:
+                    merges[dis, dblock] = mergeAdjacentCliques(
+                        cliques, dis=dis, dblock=dblock, distances=distances
+                    )
+                mergedCliquesList.append(
+                    smoothCliques(merges[dis, dblock], size, kernel_size=kernelSize)
+                )
+    errors = [
+        error(cliques, ncs, size, times, olssm=olssm) for ncs in mergedCliquesList
     ]
-    # mclen = len(mergedCliquesList)
-    # for i in range(1):
-    #     mergedCliquesList.extend(
-    #         [
-    #             smoothCliques(mergeAdjacentCliques(cs), size)
-    #             for cs in mergedCliquesList[-mclen:]
-    #         ]
-    #     )
-    errors = [error(cliques, ncs, size, times) for ncs in mergedCliquesList]
     indices = np.argsort(errors)
     for i in indices:
         newCliques = mergedCliquesList[i]
-        predicate = all(
-            [
-                len(newCliques) >= MIN_STRUCTURE_COUNT,
-            ]
-        )
-        if predicate:
+        if len(newCliques) >= MIN_STRUCTURE_COUNT:
             return newCliques
     logger.warn(f"seqrecur failed, cliqueLengths={[len(x) for x in mergedCliquesList]}")
     return mergedCliquesList[0]
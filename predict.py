@@ -9,7 +9,7 @@ import matplotlib.pyplot as plt
 
 from models.classifier import ChorusClassifier, chorusDetection, getFeatures
 from models.pickSingle import maxOverlap, tuneIntervals
-from configs.configs import logger, DEBUG, PRED_DIR, VIEWER_DATA_DIR, NUM_WORKERS, join_path
+from configs.configs import logger, DEBUG, PRED_DIR, VIEWER_DATA_DIR, NUM_WORKERS, join_path, makeDirs
 from configs.modelConfigs import (
     SSM_TIME_STEP,
     CLF_TARGET_LABEL,
@@ -18,8 +18,14 @@ from configs.modelConfigs import (
     CHORUS_DURATION_SINGLE,
     TUNE_WINDOW,
 )
-from utility.transform import ExtractMel, GenerateSSM, ExtractCliques, getFeatures
-from utility.dataset import DummyDataset, Preprocess_Dataset, buildPreprocessDataset
+from utility.transform import (
+    ExtractMel,
+    GenerateSSM,
+    ExtractCliques,
+    datasetFeatures,
+    getFeatures,
+)
+from utility.dataset import DummyDataset, buildPipeline
 from utility.algorithmsWrapper import (
     AlgoSeqRecur,
     AlgoSeqRecurSingle,
@@ -28,6 +34,7 @@ from utility.algorithmsWrapper import (
     MsafAlgosBdryOnly,
 )
 from utility.common import (
+    denseLogSSM,
     logSSM,
     extractFunctions,
     getLabeledSSM,
@@ -137,21 +144,23 @@ def switchPred(algo):
     default="multi",
 )
 @click.option(
-    "--force", nargs=1, type=click.BOOL, default=True, help="overwrite cached features."
+    "--force", nargs=1, type=click.BOOL, default=False, help="overwrite cached features."
 )
 @click.option("--workers", nargs=1, type=click.INT, default=NUM_WORKERS)
 def main(audiofiles, outputdir, metaoutputdir, algo, force, workers):
+    makeDirs()
     logger.debug(f"algo={algo}")
     logger.info(f"preprocess to generate features")
     ddataset = DummyDataset(audiofiles)
+    # cores not taken by the worker processes go to the per-modality ssm threads
+    ssmThreads = max(1, os.cpu_count() // max(1, min(workers, len(ddataset))))
     transforms = [
         ExtractMel(),
-        GenerateSSM(dataset=ddataset),
+        GenerateSSM(dataset=ddataset, num_threads=ssmThreads),
         ExtractCliques(dataset=ddataset),
     ]
-    for tf in transforms:
-        preDataset = Preprocess_Dataset(tf.identifier, ddataset)
-        preDataset.build(tf.preprocessor, force=force, num_workers=workers)
+    # every song goes through the stages as soon as its inputs are stored
+    buildPipeline(ddataset, transforms, force=force, num_workers=workers)
 
     predictor = switchPred(algo)
     predictorStruct = (
@@ -184,14 +193,11 @@ def main(audiofiles, outputdir, metaoutputdir, algo, force, workers):
             )
 
         # plot mats
-        tf = ExtractCliques(dataset=ddataset)
-        origCliques = Preprocess_Dataset(
-            tf.identifier, ddataset, transform=tf.transform
-        )[i]["cliques"]
+        origCliques = datasetFeatures(ddataset).cliques(i)
         olssm = getLabeledSSM(origCliques, ssm_f[1].shape[-1])
         lssm = getLabeledSSM(cliques, ssm_f[1].shape[-1])
         olssm = drawSegments(mirexFmt, mirexFmt, olssm, ssm_f[0])
-        mats = np.array([ssm_f[1], lssm, olssm])
+        mats = np.array([denseLogSSM(ssm_f[1]), lssm, olssm])
         titles = ["fused SSM", "result structure", "low level structure"]
         plotMats(mats, titles, show=False)
 
@@ -0,0 +1,33 @@
+import json
+import numpy as np
+import soundfile
+
+from utility import audio
+from utility.dataset import DummyDataset, Preprocess_Dataset
+
+
+def timesOnly(wavPath):
+    # stands in for a transform, it reads the audio like the real ones do
+    return {"times": np.arange(int(audio.getDuration(wavPath)) + 1, dtype=float)}
+
+
+def test_build_with_one_corrupt_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(audio.audioIndex, "path", str(tmp_path / "index.jsonl"))
+    good = str(tmp_path / "good.wav")
+    soundfile.write(good, np.zeros(8000, dtype=np.float32), 8000)
+    corrupt = str(tmp_path / "corrupt.wav")
+    with open(good, "rb") as f:
+        # the header promises more samples than the file holds
+        data = f.read()
+    with open(corrupt, "wb") as f:
+        f.write(data[:20])
+    dataset = DummyDataset([corrupt, good])
+
+    stage = Preprocess_Dataset("check", dataset, baseDir=str(tmp_path))
+    failed = stage.build(timesOnly, num_workers=1)
+
+    assert failed == [0]
+    assert stage.hasFeature(1) and not stage.hasFeature(0)
+    with open(stage.getManifestPath()) as f:
+        status = {e["title"]: e["status"] for e in map(json.loads, f)}
+    assert status == {"corrupt": "failed", "good": "done"}
@@ -6,8 +6,8 @@ and cross-similarity matrices
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.misc
-from copy import copy
 from scipy import sparse
+from concurrent.futures import ThreadPoolExecutor
 
 
 def getCSM(X, Y):
@@ -45,16 +45,144 @@ def getShiftInvariantCSM(metricFunc, wins_per_block):
         m, d = X.shape
         n_class = d // wins_per_block
         # Xr[m, n_class, wins]
-        Xr = copy(X.reshape(m, n_class, wins_per_block))
-        # Dlist[n_class, m, m]
-        DList = []
+        Xr = X.reshape(m, n_class, wins_per_block)
+        # res[m, m], minimum over the shifts reduced on the fly
+        res = None
         for shift in range(n_class):
             Xn = np.roll(Xr, shift, axis=1).reshape(m, d)
             D = metricFunc(Xn, Y)
-            DList.append(D)
-        DList = np.array(DList)
-        # res[m, m]
-        res = np.min(DList, axis=0)
+            res = D if res is None else np.minimum(res, D, out=res)
         return res
 
     return fun
+
+
+def getShiftInvariantCSMCosine(wins_per_block, blockSize=64, num_workers=1):
+    """
+    Same as getShiftInvariantCSM(getCSMCosine, wins_per_block), but all the
+    circular shifts along the class axis are evaluated at once as a circular
+    cross-correlation in the frequency domain, and the minimum is reduced
+    one block of rows at a time
+    :param wins_per_block: Number of windows stacked in a row
+    :param blockSize: Number of rows of X processed together
+    :param num_workers: Number of threads processing the row blocks
+    :return fun: A function returning the MxN shift invariant cosine distance
+    """
+
+    def spectrum(X, n_class):
+        XNorm = np.sqrt(np.sum(X ** 2, 1))
+        XNorm[XNorm == 0] = 1
+        # XHat[m, n_freq, wins]
+        X = (X / XNorm[:, None]).reshape(X.shape[0], n_class, wins_per_block)
+        return np.fft.rfft(X, axis=1)
+
+    def against(Y):
+        # the spectrum of Y is computed once for all the blocks of rows compared to it
+        n_class = Y.shape[1] // wins_per_block
+        YHat = spectrum(Y, n_class)
+        n_freq = YHat.shape[1]
+        # cross spectrum conj(X_k) . Y_k^T as real products per frequency:
+        # Re = [XRe, XIm] . [YRe, YIm]^T, Im = [XRe, -XIm] . [YIm, YRe]^T
+        # YCat[2 * n_freq, 2 * wins, n]
+        YRe = np.moveaxis(YHat.real, 1, 0)
+        YIm = np.moveaxis(YHat.imag, 1, 0)
+        YCat = np.concatenate(
+            [np.concatenate([YRe, YIm], 2), np.concatenate([YIm, YRe], 2)], 0
+        )
+        YCat = np.ascontiguousarray(np.swapaxes(YCat, 1, 2))
+        # similarity of shift s:
+        # sum_k weight_k * Re(P_k * exp(2j * pi * s * k / n_class)) / n_class
+        weights = np.full(n_freq, 2.0)
+        weights[0] = 1
+        if n_class % 2 == 0:
+            weights[-1] = 1
+        phase = 2 * np.pi * np.outer(np.arange(n_class), np.arange(n_freq)) / n_class
+        # coef[n_class, 2 * n_freq]
+        coef = np.concatenate([np.cos(phase), -np.sin(phase)], 1)
+        coef *= np.tile(weights, 2)[None, :] / n_class
+
+        def distances(X):
+            # X[m, n_class * wins]
+            m = X.shape[0]
+            XHat = spectrum(X, n_class)
+            # XCat[2 * n_freq, m, 2 * wins]
+            XRe = np.moveaxis(XHat.real, 1, 0)
+            XIm = np.moveaxis(XHat.imag, 1, 0)
+            XCat = np.concatenate(
+                [np.concatenate([XRe, XIm], 2), np.concatenate([XRe, -XIm], 2)], 0
+            )
+            res = np.empty((m, Y.shape[0]))
+
+            def rowBlock(lower):
+                higher = min(m, lower + blockSize)
+                # P[2 * n_freq, rows, n]
+                P = np.matmul(XCat[:, lower:higher], YCat)
+                # corr[n_class, rows * n], one row block of all the shifts
+                corr = coef.dot(P.reshape(P.shape[0], -1))
+                similarity = np.max(corr, axis=0).reshape(higher - lower, -1)
+                np.clip(similarity, -1, 1, out=similarity)
+                # Make sure distance 0 is the same and distance 2 is the most different
+                res[lower:higher] = 1 - similarity
+
+            lowers = range(0, m, blockSize)
+            if num_workers > 1:
+                with ThreadPoolExecutor(num_workers) as executor:
+                    list(executor.map(rowBlock, lowers))
+            else:
+                for lower in lowers:
+                    rowBlock(lower)
+            return res
+
+        return distances
+
+    def fun(X, Y):
+        return against(Y)(X)
+
+    fun.against = against
+    return fun
+
+
+def getCSMKNN(X, simFunction, K, band, blockSize=256):
+    """
+    Return a sparse self-similarity matrix keeping the distances of each
+    point to its K nearest neighbors and to the points within a temporal
+    band, computed one block of rows at a time so that the dense MxM
+    matrix is never held in memory
+    :param X: An Mxd matrix holding the coordinates of M points
+    :param simFunction: A function returning the cross-similarity matrix
+        between a block of rows of X and X, its against(X) attribute (if any)
+        returns the function of the block with the terms of X precomputed
+    :param K: Number of nearest neighbors kept per row (besides itself)
+    :param band: Number of diagonals kept on each side of the diagonal
+    :param blockSize: Number of rows computed together
+    :return D: An MxM symmetric scipy.sparse.csr_matrix, the union of the
+        neighbors of i and the points having i as a neighbor
+    """
+    M = X.shape[0]
+    K = min(K + 1, M)
+    offsets = np.arange(-band, band + 1)
+    I, J, V = [], [], []
+    if hasattr(simFunction, "against"):
+        blockFunction = simFunction.against(X)
+    else:
+        blockFunction = lambda rows: simFunction(rows, X)
+    for lower in range(0, M, blockSize):
+        higher = min(M, lower + blockSize)
+        D = blockFunction(X[lower:higher])
+        rows = np.arange(lower, higher)
+        # nearest neighbors, the point itself included
+        NN = np.argpartition(D, K - 1, 1)[:, 0:K]
+        # temporal band, clipped at the borders
+        Band = np.clip(rows[:, None] + offsets[None, :], 0, M - 1)
+        cols = np.concatenate([NN, Band], 1)
+        I.append(np.repeat(rows, cols.shape[1]))
+        J.append(cols.flatten())
+        V.append(D[(rows - lower)[:, None], cols].flatten())
+    I, J, V = np.concatenate(I), np.concatenate(J), np.concatenate(V)
+    # symmetrize the pattern, averaging the entries present on both sides
+    I, J = np.concatenate([I, J]), np.concatenate([J, I])
+    V = np.concatenate([V, V])
+    keys, inverse = np.unique(I * M + J, return_inverse=True)
+    V = np.bincount(inverse, weights=V) / np.bincount(inverse)
+    I, J = keys // M, keys % M
+    return sparse.coo_matrix((V, (I, J)), shape=(M, M)).tocsr()
@@ -84,6 +84,22 @@ def getS(W, K):
     return S
 
 
+def addBandRegularization(P, reg_diag, reg_neighbs):
+    """
+    Add the diagonal and the +-1 off-diagonals inplace, indexing the
+    bands directly instead of building dense identity and mask matrices
+    :param P: (MxM) matrix, modified inplace
+    :param reg_diag: Value added to the diagonal
+    :param reg_neighbs: Value added to the +-1 off-diagonals
+    """
+    arr = np.arange(P.shape[0])
+    if reg_diag > 0:
+        P[arr, arr] += reg_diag
+    if reg_neighbs > 0:
+        P[arr[:-1], arr[1:]] += reg_neighbs
+        P[arr[1:], arr[:-1]] += reg_neighbs
+
+
 def doSimilarityFusionWs(
     Ws,
     K=5,
@@ -91,6 +107,7 @@ def doSimilarityFusionWs(
     reg_diag=1,
     reg_neighbs=0.5,
     verboseTimes=True,
+    dtype=np.float64,
 ):
     """
     Perform similarity fusion between a set of exponentially
@@ -102,20 +119,21 @@ def doSimilarityFusionWs(
         self-similarity promotion
     :param reg_neighbs: Neighbor regularization parameter for promoting
         adjacencies in time
-    :param PlotNames: Strings describing different similarity
-        measurements for the animation
-    :param PlotExtents: Time labels for images
+    :param verboseTimes: Whether to log the time spent in each iteration
+    :param dtype: Floating point type of the diffusion (np.float32 halves
+        the memory traffic)
     :return D: A fused NxN similarity matrix
     """
     tic = time.time()
     # Full probability matrices
-    Ps = [getP(W) for W in Ws]
+    Pts = [getP(W).astype(dtype, copy=False) for W in Ws]
     # Nearest neighbor truncated matrices
-    Ss = [getS(W, K) for W in Ws]
-
-    # Now do cross-diffusion iterations
-    Pts = [np.array(P) for P in Ps]
-    nextPts = [np.zeros(P.shape) for P in Pts]
+    Ss = [getS(W, K).astype(dtype) for W in Ws]
+    # the first iteration reads the initial Pts only, later iterations
+    # read the matrices already updated in the same iteration
+    nextPts = list(Pts)
+    # average of the other modalities, reused for all iterations
+    Avg = np.empty(Pts[0].shape, dtype=dtype)
     if verboseTimes:
         logger.debug("Time getting Ss and Ps: %g" % (time.time() - tic))
 
@@ -123,38 +141,185 @@ def doSimilarityFusionWs(
     AllTimes = []
     for it in range(niters):
         ticiter = time.time()
+        avgTime, regTime = 0, 0
         for i in range(N):
-            nextPts[i] *= 0
             tic = time.time()
-            for k in range(N):
-                if i == k:
-                    continue
-                nextPts[i] += Pts[k]
-            nextPts[i] /= float(N - 1)
+            others = [k for k in range(N) if k != i]
+            np.copyto(Avg, Pts[others[0]])
+            for k in others[1:]:
+                Avg += Pts[k]
+            Avg /= float(N - 1)
 
             # Need S*P*S^T, but have to multiply sparse matrix on the left
-            tic = time.time()
-            A = Ss[i].dot(nextPts[i].T)
+            toc = time.time()
+            avgTime += toc - tic
+            tic = toc
+            A = Ss[i].dot(Avg.T)
             nextPts[i] = Ss[i].dot(A.T)
             toc = time.time()
             AllTimes.append(toc - tic)
-            if reg_diag > 0:
-                nextPts[i] += reg_diag * np.eye(nextPts[i].shape[0])
-            if reg_neighbs > 0:
-                arr = np.arange(nextPts[i].shape[0])
-                [I, J] = np.meshgrid(arr, arr)
-                # Add diagonal regularization as well
-                nextPts[i][np.abs(I - J) == 1] += reg_neighbs
+            addBandRegularization(nextPts[i], reg_diag, reg_neighbs)
+            regTime += time.time() - toc
 
         Pts = nextPts
         if verboseTimes:
             logger.debug(
-                "Elapsed Time Iter %i of %i: %g"
-                % (it + 1, niters, time.time() - ticiter)
+                "Elapsed Time Iter %i of %i: %g (average %g, multiply %g, regularize %g)"
+                % (
+                    it + 1,
+                    niters,
+                    time.time() - ticiter,
+                    avgTime,
+                    np.sum(AllTimes[-N:]),
+                    regTime,
+                )
             )
     if verboseTimes:
         logger.debug("Total Time multiplying: %g" % np.sum(np.array(AllTimes)))
-    FusedScores = np.zeros(Pts[0].shape)
-    for Pt in Pts:
+    FusedScores = np.array(Pts[0])
+    for Pt in Pts[1:]:
         FusedScores += Pt
-    return FusedScores / N
+    FusedScores /= N
+    return FusedScores
+
+
+def rowValues(A, fill):
+    """
+    Pad the stored values of each row of a sparse matrix into a dense array
+    :param A: (MxM) scipy.sparse.csr_matrix
+    :param fill: Value of the padding
+    :returns (Vals, Cols): (MxL) values and column indices, L being the
+        largest number of stored entries in a row
+    """
+    A = sparse.csr_matrix(A)
+    A.sort_indices()
+    counts = np.diff(A.indptr)
+    rows = np.repeat(np.arange(A.shape[0]), counts)
+    pos = np.arange(A.nnz) - A.indptr[rows]
+    Vals = np.full((A.shape[0], max(1, np.max(counts))), fill, dtype=A.dtype)
+    Cols = np.zeros(Vals.shape, dtype=int)
+    Vals[rows, pos] = A.data
+    Cols[rows, pos] = A.indices
+    return Vals, Cols
+
+
+def getWSparse(D, K, Mu=0.5):
+    """
+    Same as getW, restricted to the stored entries of a sparse symmetric
+    distance matrix, the other entries having no affinity
+    :param D: (MxM) scipy.sparse.csr_matrix with the diagonal and at least
+        K nearest neighbors stored in each row
+    :param K: Number of nearest neighbors
+    :param Mu: Nearest neighbor hyperparameter (default 0.5)
+    """
+    D = sparse.csr_matrix(D, copy=True)
+    D.sort_indices()
+    rows = np.repeat(np.arange(D.shape[0]), np.diff(D.indptr))
+    cols = D.indices
+    D.data[rows == cols] = 0
+    # mean distance of the K nearest neighbors, the point itself excluded
+    Vals, _ = rowValues(D, np.inf)
+    Vals[np.arange(D.shape[0]), np.argmin(Vals, 1)] = np.inf
+    Neighbs = np.sort(Vals, 1)[:, 0:K]
+    Neighbs[np.isinf(Neighbs)] = 0
+    MeanDist = np.mean(Neighbs, 1)
+    Eps = (MeanDist[rows] + MeanDist[cols] + D.data) / 3
+    Denom = 2 * (Mu * Eps) ** 2
+    Denom[Denom == 0] = 1
+    W = sparse.csr_matrix((np.exp(-(D.data ** 2) / Denom), cols, D.indptr), D.shape)
+    return W
+
+
+def getPSparse(W):
+    """
+    Same as getP without diagonal regularization, keeping the sparsity
+    pattern of W
+    :param W: (MxM) scipy.sparse.csr_matrix similarity matrix
+    :returns P: (MxM) scipy.sparse.csr_matrix probability matrix
+    """
+    P = sparse.csr_matrix(W, copy=True)
+    RowSum = np.asarray(P.sum(1)).flatten()
+    RowSum[RowSum == 0] = 1
+    P.data /= np.repeat(RowSum, np.diff(P.indptr))
+    return P
+
+
+def getSSparse(W, K):
+    """
+    Same as getS for a sparse similarity matrix, choosing the K nearest
+    neighbors among the stored entries of each row
+    :param W: (MxM) scipy.sparse.csr_matrix similarity matrix
+    :param K: Number of neighbors to use per row
+    :returns S: (MxM) S matrix
+    """
+    N = W.shape[0]
+    Vals, Cols = rowValues(W, -np.inf)
+    K = min(K, Vals.shape[1])
+    idx = np.argpartition(-Vals, K - 1, 1)[:, 0:K]
+    I = np.tile(np.arange(N)[:, None], (1, K))
+    V = Vals[I, idx]
+    J = Cols[I, idx]
+    # padded entries of short rows
+    V[np.isinf(V)] = 0
+    SNorm = np.sum(V, 1)
+    SNorm[SNorm == 0] = 1
+    V = V / SNorm[:, None]
+    [I, J, V] = [I.flatten(), J.flatten(), V.flatten()]
+    S = sparse.coo_matrix((V, (I, J)), shape=(N, N)).tocsr()
+    return S
+
+
+def doSimilarityFusionWsSparse(
+    Ws,
+    K=5,
+    niters=20,
+    reg_diag=1,
+    reg_neighbs=0.5,
+    verboseTimes=True,
+):
+    """
+    Same as doSimilarityFusionWs for sparse affinity matrices, the fused
+    matrices being kept on the union of the sparsity patterns of Ws
+    :param Ws: An array of NxN scipy.sparse.csr_matrix affinity matrices
+    :param K: Number of nearest neighbors
+    :param niters: Number of iterations
+    :param reg_diag: Identity matrix regularization parameter for
+        self-similarity promotion
+    :param reg_neighbs: Neighbor regularization parameter for promoting
+        adjacencies in time
+    :param verboseTimes: Whether to log the time spent in each iteration
+    :return D: A fused NxN scipy.sparse.csr_matrix similarity matrix
+    """
+    tic = time.time()
+    Pts = [getPSparse(W) for W in Ws]
+    Ss = [getSSparse(W, K) for W in Ws]
+    M = Pts[0].shape[0]
+    # binary union pattern, the products are truncated to it
+    Pattern = sparse.csr_matrix(Pts[0].shape)
+    for W in Ws:
+        Pattern = Pattern + (W != 0)
+    Pattern.data[:] = 1
+    Reg = sparse.diags(
+        [reg_neighbs, reg_diag, reg_neighbs], [-1, 0, 1], shape=(M, M), format="csr"
+    )
+    # the first iteration reads the initial Pts only, later iterations
+    # read the matrices already updated in the same iteration
+    nextPts = list(Pts)
+    if verboseTimes:
+        logger.debug("Time getting Ss and Ps: %g" % (time.time() - tic))
+
+    N = len(Pts)
+    for it in range(niters):
+        ticiter = time.time()
+        for i in range(N):
+            Avg = sum([Pts[k] for k in range(N) if k != i]) / float(N - 1)
+            nextPt = (Ss[i].dot(Avg)).dot(Ss[i].T)
+            nextPts[i] = sparse.csr_matrix(nextPt.multiply(Pattern)) + Reg
+        Pts = nextPts
+        if verboseTimes:
+            logger.debug(
+                "Elapsed Time Iter %i of %i: %g, nnz=%i"
+                % (it + 1, niters, time.time() - ticiter, Pts[0].nnz)
+            )
+    FusedScores = sum(Pts) / N
+    return sparse.csr_matrix(FusedScores)
@@ -37,32 +37,31 @@ options = Options()
 @click.command()
 @click.argument("file_name", type=click.Path(exists=True))
 @click.argument("outfile", type=click.Path())
-def main(file_name, outfile):
-    pitch_range = np.arange(38, 83 + 1.0 / options.resolution, 1.0 / options.resolution)
-    pitch_range = np.concatenate([np.zeros(1), pitch_range])
-
-    """  Extracting features """
-    X_test, X_spec = spec_extraction(file_name=file_name, win_size=options.input_size)
-
-    """  Prediction of melody """
-    model = melody_ResNet_joint_add(options)
-    model.load_weights("./weights/ResNet_joint_add_L(CE_G).hdf5")
-    y_predict = model.predict(X_test, batch_size=options.batch_size, verbose=1)
-
-    num_total = y_predict[0].shape[0] * y_predict[0].shape[1]
-    # y_predict_v = np.reshape(y_predict[1], (num_total, 2))
-
-    est_pitch = np.zeros(num_total)
-    index_predict = np.zeros(num_total)
-
-    y_predict = np.reshape(y_predict[0], (num_total, y_predict[0].shape[2]))  # origin
-    for i in range(y_predict.shape[0]):
-        index_predict[i] = np.argmax(y_predict[i, :])
-        pitch_MIDI = pitch_range[np.int32(index_predict[i])]
-        if pitch_MIDI >= 38 and pitch_MIDI <= 83:
-            est_pitch[i] = 2 ** ((pitch_MIDI - 69) / 12.0) * 440
-
-    est_pitch = medfilt(est_pitch, 5)
+@click.option(
+    "--signal",
+    type=click.Path(exists=True),
+    default=None,
+    help="mono signal at 8000Hz (.npy), skip decoding the input audio if given.",
+)
+@click.option(
+    "--chunk-windows",
+    type=int,
+    default=None,
+    help="stream songs longer than this number of windows chunk by chunk, bounds the memory.",
+)
+def main(file_name, outfile, signal, chunk_windows):
+    y = None if signal is None else np.load(signal)
+    model = loadModel()
+    if chunk_windows is not None:
+        _, est_pitch = predictMelody(
+            model, file_name, y=y, verbose=1, chunk_windows=chunk_windows
+        )
+        writeMel(est_pitch, outfile)
+        return
+    X_test, X_spec = spec_extraction(
+        file_name=file_name, win_size=options.input_size, y=y
+    )
+    est_pitch = predictPitch(model, X_test, verbose=1)
     writeMel(est_pitch, outfile)
 
     """ Plot """
@@ -78,8 +77,106 @@ def main(file_name, outfile):
         # plt.savefig('test.pdf', bbox_inches='tight')
 
 
+def loadModel():
+    model = melody_ResNet_joint_add(options)
+    model.load_weights("./weights/ResNet_joint_add_L(CE_G).hdf5")
+    return model
+
+
+def predictPitch(model, X_test, verbose=0):
+    """  Prediction of melody """
+    y_predict = model.predict(X_test, batch_size=options.batch_size, verbose=verbose)
+    return outputPitch(y_predict)
+
+
+def outputPitch(y_predict):
+    # network outputs of one song -> pitches
+    return medfilt(decodePitch(y_predict), 5)
+
+
+def decodePitch(y_predict):
+    # network outputs of some windows -> pitches before the median filter
+    pitch_range = np.arange(38, 83 + 1.0 / options.resolution, 1.0 / options.resolution)
+    pitch_range = np.concatenate([np.zeros(1), pitch_range])
+
+    num_total = y_predict[0].shape[0] * y_predict[0].shape[1]
+    # y_predict_v = np.reshape(y_predict[1], (num_total, 2))
+
+    y_predict = np.reshape(y_predict[0], (num_total, y_predict[0].shape[2]))  # origin
+    index_predict = np.argmax(y_predict, axis=1)
+    # frequency of every output bin, the same scalar arithmetic as the per frame loop
+    pitch_Hz = np.array(
+        [
+            2 ** ((pitch_MIDI - 69) / 12.0) * 440 if 38 <= pitch_MIDI <= 83 else 0.0
+            for pitch_MIDI in pitch_range
+        ]
+    )
+    return pitch_Hz[index_predict]
+
+
+def toMelody(pitches):
+    """times, pitches (same values as the saved text file)"""
+    times = librosa.frames_to_time(np.arange(len(pitches)), sr=8000, hop_length=80 * 1)
+    return np.round(times, 3), np.round(pitches, 4)
+
+
+def predictMelodyBatch(
+    model, file_names, ys=None, batch_size=None, verbose=0, chunk_windows=None
+):
+    """the windows of all the songs are predicted together, returns [(times, pitches)]
+    songs longer than <chunk_windows> windows are streamed chunk by chunk instead"""
+    if ys is None:
+        ys = [None] * len(file_names)
+    if batch_size is None:
+        batch_size = options.batch_size
+    ys = [loadSignal(name) if y is None else y for name, y in zip(file_names, ys)]
+    melodies = [None] * len(file_names)
+
+    batched = []
+    for i, y in enumerate(ys):
+        num_windows = -(-(1 + len(y) // 80) // options.input_size)
+        if chunk_windows is None or num_windows <= chunk_windows:
+            batched.append(i)
+            continue
+        # the median filter runs on the stitched track, identical at the boundaries
+        pitches = [
+            decodePitch(model.predict(X_test, batch_size=batch_size, verbose=verbose))
+            for X_test in spec_extraction_chunks(
+                file_names[i], options.input_size, y=y, chunk_windows=chunk_windows
+            )
+        ]
+        melodies[i] = toMelody(medfilt(np.concatenate(pitches), 5))
+    if not batched:
+        return melodies
+
+    X_tests = [
+        spec_extraction(file_name=file_names[i], win_size=options.input_size, y=ys[i])[0]
+        for i in batched
+    ]
+    splits = np.cumsum([len(X_test) for X_test in X_tests])[:-1]
+    y_predict = model.predict(
+        np.concatenate(X_tests), batch_size=batch_size, verbose=verbose
+    )
+    # the model has several outputs, split each of them by song
+    y_predicts = zip(*[np.split(output, splits) for output in y_predict])
+    for i, song_predict in zip(batched, y_predicts):
+        melodies[i] = toMelody(outputPitch(list(song_predict)))
+    return melodies
+
+
+def predictMelody(model, file_name, y=None, verbose=0, chunk_windows=None):
+    """returns times, pitches (same values as the saved text file)"""
+    return predictMelodyBatch(
+        model, [file_name], [y], verbose=verbose, chunk_windows=chunk_windows
+    )[0]
+
+
 def writeMel(pitches, outfile):
     times = librosa.frames_to_time(np.arange(len(pitches)), sr=8000, hop_length=80 * 1)
+    if outfile.endswith(".npy"):
+        # binary [<frame>, (time, pitch)], same values as the text output
+        np.save(outfile, np.stack([np.round(times, 3), np.round(pitches, 4)], axis=1))
+        return
     np.savetxt(
         outfile, np.array([times, pitches]).T, fmt=["%.3f", "%.4f"], delimiter="\t"
     )
@@ -1,43 +1,105 @@
 # -*- coding: utf-8 -*-
 import librosa
 from madmom.audio.signal import *
+import os
+import tempfile
+from functools import lru_cache
 from pathlib import Path
 import matplotlib.pyplot as plt
 
 
-def spec_extraction(file_name, win_size):
+def spec_extraction(file_name, win_size, y=None):
     currentFilePath = str(Path(__file__).resolve().parent)
     # print(currentFilePath)
 
-    x_test = []
-
-    # y, sr = librosa.load(file_name, sr=8000)
-    # *********** madmom.Signal() is faster than librosa.load() ***********
-    y = Signal(file_name, sample_rate=8000, dtype=np.float32, num_channels=1)
+    # y: mono signal at 8000Hz already decoded by the caller
+    if y is None:
+        y = loadSignal(file_name)
     S = librosa.core.stft(y, n_fft=1024, hop_length=80 * 1, win_length=1024)
     x_spec = np.abs(S)
     x_spec = librosa.core.power_to_db(x_spec, ref=np.max)
     x_spec = x_spec.astype(np.float32)
+    return spec_windows(x_spec, win_size, currentFilePath)
+
+
+def spec_windows(x_spec, win_size, dirname):
     num_frames = x_spec.shape[1]
 
-    # for padding
+    # for padding (float32 zeros, the spectrogram is not upcast)
     padNum = num_frames % win_size
     if padNum != 0:
         len_pad = win_size - padNum
-        padding_feature = np.zeros(shape=(513, len_pad))
-        x_spec = np.concatenate((x_spec, padding_feature), axis=1)
+        x_spec = np.pad(x_spec, ((0, 0), (0, len_pad)), mode="constant")
         num_frames = num_frames + len_pad
 
-    for j in range(0, num_frames, win_size):
-        x_test_tmp = x_spec[:, range(j, j + win_size)].T
-        x_test.append(x_test_tmp)
-    x_test = np.array(x_test)
+    # windows[<window>, <frame>, <bin>] as a strided view of x_spec
+    windows = np.lib.stride_tricks.as_strided(
+        x_spec,
+        shape=(num_frames // win_size, win_size, x_spec.shape[0]),
+        strides=(x_spec.strides[1] * win_size, x_spec.strides[1], x_spec.strides[0]),
+        writeable=False,
+    )
 
-    # for normalization
-
-    x_train_mean = np.load(currentFilePath + "/x_data_mean_total_31.npy")
-    x_train_std = np.load(currentFilePath + "/x_data_std_total_31.npy")
-    x_test = (x_test - x_train_mean) / (x_train_std + 0.0001)
-    x_test = x_test[:, :, :, np.newaxis]
+    # for normalization, written in place into the float32 input tensor
+    x_train_mean, x_train_std = loadNormalization(dirname)
+    x_test = np.empty(windows.shape + (1,), dtype=np.float32)
+    np.subtract(windows, x_train_mean, out=x_test[:, :, :, 0])
+    x_test /= x_train_std[:, :, np.newaxis]
 
     return x_test, x_spec
+
+
+def spec_extraction_chunks(file_name, win_size, y=None, chunk_windows=2048, top_db=80.0):
+    """same windows as spec_extraction, yielded <chunk_windows> windows at a time,
+    the stft is computed once, chunk by chunk, and only one chunk of it and of the
+    input tensor is in memory, the decoded 8000Hz signal itself is held whole
+    (~115MB per hour)"""
+    currentFilePath = str(Path(__file__).resolve().parent)
+    if y is None:
+        y = loadSignal(file_name)
+    n_fft, hop = 1024, 80
+    num_frames = 1 + len(y) // hop  # centered frames
+    # frames of samples needed around a chunk by the first/last frame
+    margin = -(-(n_fft // 2) // hop)
+    chunk_frames = chunk_windows * win_size
+    chunks = [
+        (start, min(start + chunk_frames, num_frames))
+        for start in range(0, num_frames, chunk_frames)
+    ]
+
+    def magnitude(start, end):
+        # frames [start, end) of the stft of the whole signal
+        begin = max(0, (start - margin) * hop)
+        stop = min(len(y), (end - 1 + margin) * hop + 1)
+        S = librosa.core.stft(y[begin:stop], n_fft=n_fft, hop_length=hop, win_length=n_fft)
+        offset = start - begin // hop
+        return np.abs(S[:, offset : offset + end - start])
+
+    # the decibel reference and floor are global, the magnitudes wait in a temporary
+    # file (frames x bins) while the first pass finds the maximum
+    with tempfile.TemporaryFile() as f:
+        spec = np.memmap(f, dtype=np.float32, mode="w+", shape=(num_frames, n_fft // 2 + 1))
+        ref = 0
+        for start, end in chunks:
+            S = magnitude(start, end)
+            spec[start:end] = S.T
+            ref = max(ref, S.max())
+        floor = librosa.core.power_to_db(np.array([ref]), ref=ref, top_db=None)[0] - top_db
+        for start, end in chunks:
+            S = np.array(spec[start:end].T)
+            x_spec = librosa.core.power_to_db(S, ref=ref, top_db=None)
+            x_spec = np.maximum(x_spec, floor).astype(np.float32)
+            yield spec_windows(x_spec, win_size, currentFilePath)[0]
+
+
+def loadSignal(file_name):
+    # y, sr = librosa.load(file_name, sr=8000)
+    # madmom.Signal() is faster than librosa.load()
+    return Signal(file_name, sample_rate=8000, dtype=np.float32, num_channels=1)
+
+
+@lru_cache(maxsize=None)
+def loadNormalization(dirname):
+    x_train_mean = np.load(os.path.join(dirname, "x_data_mean_total_31.npy"))
+    x_train_std = np.load(os.path.join(dirname, "x_data_std_total_31.npy"))
+    return x_train_mean.astype(np.float32), (x_train_std + 0.0001).astype(np.float32)
@@ -11,49 +11,107 @@ from model import *
 from featureExtraction import *
 
 
-def melodyExtraction_NS(file_name, output_path, gpu_index):
+def loadModel(gpu_index=None):
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     if gpu_index is None:
         os.environ["CUDA_VISIBLE_DEVICES"] = ""
     else:
         os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu_index)
 
+    model = melody_ResNet()
+    model.load_weights("./weights/ResNet_NS.hdf5")
+    return model
+
+
+def decodePitch(y_predict):
+    """ network output of some windows -> pitch of every frame """
     note_res = 8
     pitch_range = np.arange(40, 95 + 1.0 / note_res, 1.0 / note_res)
     pitch_range = np.concatenate([np.zeros(1), pitch_range])
 
+    y_shape = y_predict.shape
+    num_total_frame = y_shape[0] * y_shape[1]
+    y_predict = np.reshape(y_predict, (num_total_frame, y_shape[2]))
+
+    index_predict = np.argmax(y_predict, axis=1)
+    # frequency of every output bin, the same scalar arithmetic as the per frame loop
+    pitch_Hz = np.array(
+        [
+            2 ** ((pitch_MIDI - 69) / 12.0) * 440 if 45 <= pitch_MIDI <= 95 else 0.0
+            for pitch_MIDI in pitch_range
+        ]
+    )
+    return pitch_Hz[index_predict]
+
+
+def toMelody(est_pitch):
+    """ times, pitches (same values as the saved text file) """
+    times = np.round(0.01 * np.arange(len(est_pitch)), 2)
+    return times, np.round(est_pitch, 4)
+
+
+def predictMelodyBatch(model, file_names, ys=None, batch_size=64, verbose=0, chunk_windows=None):
+    """ the windows of all the songs are predicted together, returns [(times, pitches)]
+    songs longer than <chunk_windows> windows are streamed chunk by chunk instead """
+    if ys is None:
+        ys = [None] * len(file_names)
+    ys = [loadSignal(file_name) if y is None else y for file_name, y in zip(file_names, ys)]
+    melodies = [None] * len(file_names)
+
+    """  streamed long songs """
+    batched = []
+    for i, y in enumerate(ys):
+        num_windows = -(-(1 + len(y) // 80) // 31)
+        if chunk_windows is None or num_windows <= chunk_windows:
+            batched.append(i)
+            continue
+        est_pitch = [
+            decodePitch(model.predict(X_test, batch_size=batch_size, verbose=verbose))
+            for X_test in spec_extraction_chunks(
+                file_names[i], win_size=31, y=y, chunk_windows=chunk_windows
+            )
+        ]
+        melodies[i] = toMelody(np.concatenate(est_pitch))
+    if not batched:
+        return melodies
+
     """  Features extraction"""
-    X_test, X_spec = spec_extraction(file_name=file_name, win_size=31)
+    X_tests = [
+        spec_extraction(file_name=file_names[i], win_size=31, y=ys[i])[0]
+        for i in batched
+    ]
+    counts = [len(X_test) for X_test in X_tests]
 
     """  melody predict"""
-    model = melody_ResNet()
-    model.load_weights("./weights/ResNet_NS.hdf5")
-    y_predict = model.predict(X_test, batch_size=64, verbose=1)
+    y_predict = model.predict(
+        np.concatenate(X_tests), batch_size=batch_size, verbose=verbose
+    )
+    y_predicts = np.split(y_predict, np.cumsum(counts)[:-1])
+    for i, y_predict in zip(batched, y_predicts):
+        melodies[i] = toMelody(decodePitch(y_predict))
+    return melodies
 
-    y_shape = y_predict.shape
-    num_total_frame = y_shape[0] * y_shape[1]
-    est_pitch = np.zeros(num_total_frame)
-    index_predict = np.zeros(num_total_frame)
 
-    y_predict = np.reshape(y_predict, (num_total_frame, y_shape[2]))
+def predictMelody(model, file_name, y=None, verbose=0, chunk_windows=None):
+    """ returns times, pitches (same values as the saved text file) """
+    return predictMelodyBatch(
+        model, [file_name], [y], verbose=verbose, chunk_windows=chunk_windows
+    )[0]
 
-    for i in range(num_total_frame):
-        index_predict[i] = np.argmax(y_predict[i, :])
-        pitch_MIDI = pitch_range[np.int32(index_predict[i])]
-        if pitch_MIDI >= 45 and pitch_MIDI <= 95:
-            est_pitch[i] = 2 ** ((pitch_MIDI - 69) / 12.0) * 440
 
-    """ save results """
-    PATH_est_pitch = os.path.join(output_path, "pitch_"+os.path.basename(file_name)+".txt")
+def melodyExtraction_NS(file_name, output_path, gpu_index, signal_path=None, chunk_windows=None):
+    model = loadModel(gpu_index)
+    y = None if signal_path is None else np.load(signal_path)
+    times, est_pitch = predictMelody(
+        model, file_name, y=y, verbose=1, chunk_windows=chunk_windows
+    )
+
+    """ save results: [<frame>, (time, pitch)] """
+    PATH_est_pitch = os.path.join(output_path, "pitch_"+os.path.basename(file_name)+".npy")
     if not os.path.exists(os.path.dirname(PATH_est_pitch)):
         os.makedirs(os.path.dirname(PATH_est_pitch))
-    f = open(PATH_est_pitch, "w")
-    for j in range(len(est_pitch)):
-        est = "%.2f %.4f\n" % (0.01 * j, est_pitch[j])
-        f.write(est)
-    f.close()
-
-    est_arr = np.loadtxt(PATH_est_pitch)
+    est_arr = np.stack([times, est_pitch], axis=1)
+    np.save(PATH_est_pitch, est_arr)
     return est_arr
 
 
@@ -80,11 +138,29 @@ def parser():
         type=int,
         default=None,
     )
+    p.add_argument(
+        "-s",
+        "--signal_path",
+        help="Path to a .npy of the mono signal at 8000Hz, skip decoding the input audio if given (default: %(default)s",
+        type=str,
+        default=None,
+    )
+    p.add_argument(
+        "-c",
+        "--chunk_windows",
+        help="Stream songs longer than this number of 31-frame windows chunk by chunk, bounds the memory (default: %(default)s",
+        type=int,
+        default=None,
+    )
     return p.parse_args()
 
 
 if __name__ == "__main__":
     args = parser()
     melodyExtraction_NS(
-        file_name=args.filepath, output_path=args.output_dir, gpu_index=args.gpu_index
+        file_name=args.filepath,
+        output_path=args.output_dir,
+        gpu_index=args.gpu_index,
+        signal_path=args.signal_path,
+        chunk_windows=args.chunk_windows,
     )
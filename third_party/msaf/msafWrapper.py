@@ -284,6 +284,7 @@ def process(
     config=None,
     out_bounds="out_bounds.wav",
     out_sr=22050,
+    dur=None,
 ):
     """Main process to segment a file or a collection of files.
 
@@ -322,6 +323,9 @@ def process(
         mode, when sonify_bounds is True.
     out_sr : int
         Sampling rate for the sonified bounds.
+    dur : float
+        Duration of the audio file in seconds, if already known by the
+        caller. If None, it is read from the file.
 
     Returns
     -------
@@ -369,7 +373,8 @@ def process(
     )
 
     # fix duration
-    dur = librosa.get_duration(filename=in_path)
+    if dur is None:
+        dur = librosa.get_duration(filename=in_path)
     while len(est_times) > 1 and est_times[-2] >= dur:
         est_times = est_times[:-1]
         est_labels = est_labels[:-1]
@@ -1,7 +1,6 @@
 import os
 import json
 import subprocess
-import librosa
 import numpy as np
 from itertools import chain
 from scipy.stats import mode
@@ -9,7 +8,7 @@ from pychorus import find_and_output_chorus
 from mir_eval.io import load_labeled_intervals
 
 from models.classifier import ChorusClassifier, chorusDetection, getFeatures
-from utility.transform import ExtractCliques, GenerateSSM
+from utility.transform import datasetFeatures
 from third_party.msaf.msafWrapper import process
 from models.seqRecur import (
     buildRecurrence,
@@ -17,9 +16,12 @@ from models.seqRecur import (
     affinityPropagation,
 )
 from models.pickSingle import maxOverlap, tuneIntervals
-from utility.dataset import DATASET_BASE_DIRS, Preprocess_Dataset, convertFileName
+from utility.audio import getDuration
+from utility.dataset import DATASET_BASE_DIRS, convertFileName
+from utility.shardStore import ShardStore
 from utility.common import (
     cliquesFromArr,
+    denseLogSSM,
     matchCliqueLabel,
     matchLabel,
     singleChorusSection,
@@ -35,7 +37,7 @@ from configs.modelConfigs import (
     TUNE_WINDOW,
     CLF_TARGET_LABEL,
 )
-from configs.configs import logger, ALGO_BASE_DIRS
+from configs.configs import FEATURE_STORE, logger, ALGO_BASE_DIRS
 
 
 class AlgoSeqRecur:
@@ -56,10 +58,7 @@ class AlgoSeqRecur:
         return self._process(dataset, idx, ssm_f)
 
     def _process(self, dataset, idx, ssm_f):
-        tf = ExtractCliques(dataset=dataset)
-        cliques_set = Preprocess_Dataset(tf.identifier, dataset, transform=tf.transform)
-        cliquesSample = cliques_set[idx]
-        origCliques = cliquesSample["cliques"]
+        origCliques = datasetFeatures(dataset).cliques(idx)
         # origCliques = ssmStructure_sr(ssm_f)
         cliques = buildRecurrence(origCliques, ssm_f[0])
         return cliques
@@ -142,7 +141,9 @@ class MsafAlgos(BaseMsafAlgos):
         wavPath = dataset[idx]["wavPath"]
         times = ssm_f[0]
         feat, est = self.cacheFile(dataset, idx)
-        boundaries, labels = process(wavPath, self.bd, feat, est)
+        boundaries, labels = process(
+            wavPath, self.bd, feat, est, dur=getDuration(wavPath)
+        )
         tIntvs = np.array([boundaries[:-1], boundaries[1:]]).T
         arr = np.zeros(len(times) - 1, dtype=int)
         for tIntv, label in zip(tIntvs, labels):
@@ -163,12 +164,13 @@ class MsafAlgosBdryOnly(BaseMsafAlgos):
     def _process(self, dataset, idx, ssm_f):
         wavPath = dataset[idx]["wavPath"]
         feat, est = self.cacheFile(dataset, idx)
-        boundaries, _ = process(wavPath, self.bd, feat, est)
+        boundaries, _ = process(wavPath, self.bd, feat, est, dur=getDuration(wavPath))
         times = ssm_f[0]
         tIntvs = np.array([boundaries[:-1], boundaries[1:]]).T
         tlen = len(tIntvs)
         # logger.debug(f"tIntvs={tIntvs}")
-        ssm = ssm_f[1] - np.max(ssm_f[1])
+        ssm = denseLogSSM(ssm_f[1])
+        ssm = ssm - np.max(ssm)
         median = np.median(ssm)
         for i in range(ssm.shape[0]):
             ssm[i, i] = median
@@ -226,10 +228,10 @@ class MsafAlgosBound(BaseMsafAlgos):
         wavPath = sample["wavPath"]
         gt = sample["gt"]
         feat, est = self.cacheFile(dataset, idx)
-        boundaries, _ = process(wavPath, self.bd, feat, est)
+        boundaries, _ = process(wavPath, self.bd, feat, est, dur=getDuration(wavPath))
         est_intvs = np.array([boundaries[:-1], boundaries[1:]]).T
         est_labels = matchLabel(est_intvs, gt)
-        dur = librosa.get_duration(filename=wavPath)
+        dur = getDuration(wavPath)
         while est_intvs[-1][0] >= dur:
             est_intvs = est_intvs[:-1]
             est_labels = est_labels[:-1]
@@ -242,11 +244,8 @@ class GroudTruthStructure:
         self.clf = ChorusClassifier(trainFile)
 
     def getStructure(self, dataset, idx):
-        tf = GenerateSSM(dataset=dataset)
-        target = Preprocess_Dataset(tf.identifier, dataset, transform=tf.transform)[
-            idx
-        ]["target"]
-        cliques = cliquesFromArr([target[i, i] for i in range(target.shape[0])])
+        target = datasetFeatures(dataset).ssm_set[idx]["target"]
+        cliques = cliquesFromArr(target.diagonal())
         return cliques
 
     def __call__(self, dataset, idx):
@@ -259,16 +258,23 @@ class GroudTruthStructure:
 class CachedAlgo:
     def __init__(self, dirname, baseDir=DATASET_BASE_DIRS["LocalTemporary_Dataset"]):
         self.cacheDir = os.path.join(baseDir, dirname)
-        if not os.path.exists(self.cacheDir):
+        self.store = None
+        if FEATURE_STORE == "shard":
+            self.store = ShardStore(f"{self.cacheDir}.shards")
+        elif not os.path.exists(self.cacheDir):
             os.mkdir(self.cacheDir)
 
-    def _cacheFile(self, dataset, idx):
+    def _cacheKey(self, dataset, idx):
         title = dataset[idx]["title"]
-        return os.path.join(
-            self.cacheDir, f"{dataset.__class__.__name__}-{idx}-{title}.json"
-        )
+        return f"{dataset.__class__.__name__}-{idx}-{title}"
+
+    def _cacheFile(self, dataset, idx):
+        return os.path.join(self.cacheDir, f"{self._cacheKey(dataset, idx)}.json")
 
     def readCache(self, dataset, idx):
+        if self.store is not None:
+            key = self._cacheKey(dataset, idx)
+            return self.store.get(key) if key in self.store else None
         filename = self._cacheFile(dataset, idx)
         if not os.path.exists(filename):
             return None
@@ -277,12 +283,23 @@ class CachedAlgo:
             return data
 
     def writeCache(self, dataset, idx, data):
+        if self.store is not None:
+            self.store.put(self._cacheKey(dataset, idx), data)
+            return
         filename = self._cacheFile(dataset, idx)
         with open(filename, "w") as f:
             logger.info(f"writing to cache, path={filename}")
             json.dump(data, f)
 
 
+def compactCachedAlgos(baseDir=DATASET_BASE_DIRS["LocalTemporary_Dataset"]):
+    # drop the overwritten records of the cached results, shard stores only
+    for dirname in ["highlighter-cache", "RefraiD-cache"]:
+        root = os.path.join(baseDir, f"{dirname}.shards")
+        if os.path.exists(root):
+            ShardStore(root).compact()
+
+
 class PopMusicHighlighter(CachedAlgo):
     def __init__(self):
         super(PopMusicHighlighter, self).__init__("highlighter-cache")
@@ -305,7 +322,7 @@ class PopMusicHighlighter(CachedAlgo):
 
     def __call__(self, dataset, idx):
         wavPath = dataset[idx]["wavPath"]
-        dur = librosa.get_duration(filename=wavPath)
+        dur = getDuration(wavPath)
         data = self.readCache(dataset, idx)
         if data is not None:
             start, end = data["start"], data["end"]
@@ -334,7 +351,7 @@ class RefraiD(CachedAlgo):
 
     def __call__(self, dataset, idx):
         wavPath = dataset[idx]["wavPath"]
-        dur = librosa.get_duration(filename=wavPath)
+        dur = getDuration(wavPath)
         data = self.readCache(dataset, idx)
         if data is not None:
             start, length = data["start"], data["length"]
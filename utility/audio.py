@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import audioread
+import soundfile
+import numpy as np
+
+from configs.configs import AUDIO_INDEX
+from configs.modelConfigs import MEL_SAMPLE_RATE
+
+
+def melodySignal(wavPath, sr=MEL_SAMPLE_RATE):
+    """input of the melody extractors, decoded and resampled by madmom like the
+    extractors themselves do, their models were trained on this signal"""
+    # only the processes extracting melodies need madmom
+    from madmom.audio.signal import Signal
+
+    return np.asarray(Signal(wavPath, sample_rate=sr, dtype=np.float32, num_channels=1))
+
+
+def probeAudio(absPath):
+    """duration, sample rate and channels from the header, no decoding"""
+    try:
+        info = soundfile.info(absPath)
+        return {
+            "duration": info.frames / info.samplerate,
+            "sr": info.samplerate,
+            "channels": info.channels,
+        }
+    except Exception:
+        # formats libsndfile can't read, the same fallback as librosa.get_duration
+        with audioread.audio_open(absPath) as f:
+            return {"duration": f.duration, "sr": f.samplerate, "channels": f.channels}
+
+
+def contentHash(absPath):
+    sha = hashlib.sha1()
+    with open(absPath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()[:16]
+
+
+class AudioIndex:
+    """metadata of audio files (duration, sample rate, channels, content hash)
+    in an append-only json lines file shared by all the processes, keyed by
+    absolute path, an entry is valid while the size and mtime of the file
+    are unchanged"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.offset = 0  # bytes of the file already read
+
+    def refresh(self):
+        # lines appended since the last read, by this or other processes
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # still being written
+                    break
+                self.offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[entry["path"]] = entry
+
+    def lookup(self, absPath, st):
+        for refresh in [False, True]:
+            if refresh:
+                self.refresh()
+            entry = self.entries.get(absPath)
+            if entry and (entry["size"], entry["mtime"]) == (
+                st.st_size,
+                st.st_mtime_ns,
+            ):
+                return entry
+        return {}
+
+    def get(self, wavPath, field):
+        absPath = os.path.abspath(wavPath)
+        st = os.stat(absPath)
+        entry = self.lookup(absPath, st)
+        if field not in entry:
+            # the content hash reads the whole file, it is only computed on demand
+            new = (
+                {"hash": contentHash(absPath)}
+                if field == "hash"
+                else probeAudio(absPath)
+            )
+            entry = dict(entry, path=absPath, size=st.st_size, mtime=st.st_mtime_ns)
+            entry.update(new)
+            self.entries[absPath] = entry
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+        return entry[field]
+
+
+audioIndex = AudioIndex(AUDIO_INDEX)
+
+
+def getDuration(wavPath):
+    return audioIndex.get(wavPath, "duration")
+
+
+def audioInfo(wavPath):
+    """duration, sample rate and channels of the audio file"""
+    return {key: audioIndex.get(wavPath, key) for key in ["duration", "sr", "channels"]}
+
+
+def audioHash(wavPath):
+    """content hash of the audio file, cache keys follow the content instead of the name"""
+    return audioIndex.get(wavPath, "hash")
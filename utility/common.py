@@ -1,6 +1,9 @@
+import zlib
+import hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 from typing import List
+from scipy import sparse
 
 from configs.configs import DEBUG, logger
 from configs.modelConfigs import (
@@ -10,8 +13,41 @@ from configs.modelConfigs import (
     MINIMUM_CHORUS_DUR,
     CLF_TARGET_LABEL,
     CLF_NON_TARGET_LABEL,
+    SSM_STORE_COMPRESS,
+    SSM_STORE_DTYPE,
+    SSM_STORE_TOLERANCE,
 )
 from collections import defaultdict
+from collections.abc import Mapping
+
+
+def configFingerprint(config):
+    # short stable hash of a dict of constants (numbers, strings, tuples, dtypes)
+    text = repr(sorted(config.items()))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+
+
+class LazyRegistry(Mapping):
+    """name -> object, each object is built by its factory on the first access"""
+
+    def __init__(self, factories):
+        self.factories = dict(factories)
+        self.built = {}
+
+    def __getitem__(self, name):
+        if name not in self.built:
+            self.built[name] = self.factories[name]()
+        return self.built[name]
+
+    def __contains__(self, name):
+        # membership never builds
+        return name in self.factories
+
+    def __iter__(self):
+        return iter(self.factories)
+
+    def __len__(self):
+        return len(self.factories)
 
 
 def cliqueTails(clique):
@@ -191,12 +227,89 @@ def getLabeledSSM(cliques, size):
 def logSSM(ssm, inplace=True):
     if not inplace:
         ssm = ssm.copy()
+    if sparse.issparse(ssm):
+        # stored entries only, missing entries of sparse ssm have no affinity
+        ssm.data[ssm.data < 0] = 0
+        ssm.data += EPSILON
+        ssm.data = np.log(ssm.data)
+        return ssm
     ssm[ssm < 0] = 0
     ssm += EPSILON
     ssm = np.log(ssm)
     return ssm
 
 
+class CompressedArray:
+    """zlib compressed array, np.asarray decompresses it"""
+
+    def __init__(self, arr, level=6):
+        arr = np.ascontiguousarray(arr)
+        self.dtype, self.shape = arr.dtype, arr.shape
+        self.data = zlib.compress(arr.tobytes(), level)
+
+    def __array__(self, dtype=None, copy=None):
+        arr = np.frombuffer(zlib.decompress(self.data), dtype=self.dtype)
+        arr = arr.reshape(self.shape)
+        return arr if dtype is None else arr.astype(dtype)
+
+
+def encodeSSM(
+    ssm,
+    dtype=SSM_STORE_DTYPE,
+    compress=SSM_STORE_COMPRESS,
+    tolerance=SSM_STORE_TOLERANCE,
+):
+    """storage form of a dense log ssm (stack), a lossy dtype is only kept if
+    its largest error stays under tolerance"""
+    for candidate in [dtype, np.float32, ssm.dtype]:
+        if np.dtype(candidate).itemsize > ssm.dtype.itemsize:
+            continue
+        stored = ssm.astype(candidate, copy=False)
+        error = np.max(np.abs(stored - ssm)) if stored is not ssm else 0
+        if error <= tolerance:
+            break
+        logger.warn(f"{np.dtype(candidate).name} ssm error={error:.3g} > {tolerance}")
+    return CompressedArray(stored) if compress else stored
+
+
+class WidenedArray:
+    """float16 array read as float32, numpy indexing or np.asarray widen only the
+    requested part, a memory-mapped array stays on disk until it is indexed"""
+
+    def __init__(self, arr, dtype=np.float32):
+        self.arr = arr
+        self.dtype = np.dtype(dtype)
+        self.shape = arr.shape
+        self.ndim = arr.ndim
+
+    def __len__(self):
+        return len(self.arr)
+
+    def __getitem__(self, key):
+        return np.asarray(self.arr[key]).astype(self.dtype)[()]
+
+    def __array__(self, dtype=None, copy=None):
+        return self.arr.astype(self.dtype if dtype is None else dtype)
+
+
+def decodeSSM(ssm):
+    # float16 is widened for the arithmetic of the readers, per indexed block
+    if isinstance(ssm, list):
+        return ssm
+    ssm = np.asarray(ssm)
+    return WidenedArray(ssm) if ssm.dtype == np.float16 else ssm
+
+
+def denseLogSSM(ssm):
+    # missing entries of sparse log ssm are filled with the lowest similarity
+    if sparse.issparse(ssm):
+        res = np.full(ssm.shape, np.log(EPSILON))
+        coo = ssm.tocoo()
+        res[coo.row, coo.col] = coo.data
+        return res
+    return ssm
+
+
 def expSSM(ssm, inplace=True):
     if not inplace:
         ssm = ssm.copy()
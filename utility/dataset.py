@@ -1,18 +1,29 @@
 import os
+import json
 import time
+import queue
 import pickle
-import librosa
-import time
+import shutil
 import unicodedata
 import numpy as np
-from copy import deepcopy, copy
+from copy import copy
+from functools import partial
 from itertools import chain
 from collections import namedtuple
-from multiprocessing import Pool
 from tqdm import tqdm
 from mir_eval.io import load_labeled_events, load_labeled_intervals
 
-from configs.configs import DATASET_BASE_DIRS, NUM_WORKERS, logger
+from utility.audio import audioHash, getDuration
+from utility.parallel import callResident, residentPool, scheduledMap
+from utility.shardStore import ShardStore
+from configs.configs import (
+    DATASET_BASE_DIRS,
+    BUILD_RETRIES,
+    FEATURE_STORE,
+    MELODY_BATCH_SONGS,
+    NUM_WORKERS,
+    logger,
+)
 
 
 StructDataPathPair = namedtuple("StructDataPathPair", "title wav GT")
@@ -52,7 +63,7 @@ class BaseStructDataset:
         # force gt intervals in range (0, AudioDuration)
         # assert intervals[0][0] == 0, f'{GTPath}'
         intervals[0][0] = 0
-        dur = librosa.get_duration(filename=wavPath)
+        dur = getDuration(wavPath)
         while intervals[-1][0] >= dur:
             intervals = intervals[:-1]
             labels = labels[:-1]
@@ -65,15 +76,30 @@ class BaseStructDataset:
             sample = self.transform(sample)
         return sample
 
+    def getDurations(self):
+        return [getDuration(pair.wav) for pair in self.pathPairs]
+
+    def getWeights(self):
+        # durations as scheduling weights, an unreadable song weighs 0 and
+        # fails later in its own task instead of aborting the whole pool
+        weights = []
+        for pair in self.pathPairs:
+            try:
+                weights.append(getDuration(pair.wav))
+            except Exception as e:
+                logger.warn(f"no duration for {pair.wav}: {e!r}")
+                weights.append(0)
+        return weights
+
     def getLabels(self, refresh=False):
-        # all distinct labels in the dataset
+        # all distinct labels in the dataset, parsed once
         if refresh or self.labelSet is None:
             labelSet = set()
             for pair in self.pathPairs:
                 _, labels = self.loadGT(pair.GT)
                 labelSet = labelSet.union(labels)
-            labelSet = sorted(labelSet)
-        return labelSet
+            self.labelSet = sorted(labelSet)
+        return self.labelSet
 
     def loadGT(self, GTPath):
         raise NotImplementedError
@@ -89,9 +115,12 @@ class BaseStructDataset:
         a_pathPairs = [self.pathPairs[i] for i in indices[:newLen]]
         b_pathPairs = [self.pathPairs[i] for i in indices[newLen:]]
 
-        a, b = deepcopy(self), deepcopy(self)
+        # shallow views, the subsets share everything but their songs
+        a, b = copy(self), copy(self)
         a.pathPairs = a_pathPairs
         b.pathPairs = b_pathPairs
+        # labels of the subsets are collected again
+        a.labelSet, b.labelSet = None, None
         return a, b
 
 
@@ -445,7 +474,7 @@ class Preprocess_Dataset:
         transform=None,
     ):
         self.baseDir = baseDir
-        self.tid = tid  # unique transform id to distinguish from same filename
+        self.tid = tid  # transform identifier with the fingerprint of its configuration
         self.dataset = dataset
         self.ddir = os.path.join(baseDir, dataset.__class__.__name__)
         self.transform = transform
@@ -454,43 +483,224 @@ class Preprocess_Dataset:
         ), f"{type(dataset)} is not {type(BaseStructDataset)}"
         if not os.path.exists(self.ddir):
             os.mkdir(self.ddir)
+        # one shard store per transform, <ddir>/<id>.shards/
+        self.store = (
+            ShardStore(os.path.join(self.ddir, f"{tid}.shards"))
+            if FEATURE_STORE == "shard"
+            else None
+        )
 
-    def build(self, preprocessor, force=False, num_workers=NUM_WORKERS):
+    def build(
+        self,
+        preprocessor,
+        force=False,
+        num_workers=NUM_WORKERS,
+        batchPreprocessor=None,
+        batchSongs=1,
+    ):
+        """batchPreprocessor: optional, processes <batchSongs> audio files for each call"""
         logger.info(
             f"building <{self.__class__.__name__}> from <{self.dataset.__class__.__name__}> with transform identifier=<{self.tid}>"
         )
+        self.prepare(preprocessor, force, batchPreprocessor)
+        durations = self.dataset.getWeights()
+        todo = [i for i in range(len(self.dataset)) if self.needBuild(i)]
+        if batchPreprocessor is None:
+            batches = [[i] for i in todo]
+        else:
+            # songs of similar lengths share a batch
+            todo.sort(key=lambda i: durations[i], reverse=True)
+            batches = [
+                todo[i : i + batchSongs] for i in range(0, len(todo), batchSongs)
+            ]
+        # the workers hold this object, a task is only the indices of its songs
+        failed = scheduledMap(
+            self.storeBatch,
+            [(batch,) for batch in batches],
+            weights=[sum(durations[i] for i in batch) for batch in batches],
+            num_workers=num_workers,
+        )
+        failed = list(chain(*failed))
+        if failed:
+            logger.warn(
+                f"{len(failed)} of {len(todo)} songs failed, see {self.getManifestPath()}, building again retries them"
+            )
+        return failed
+
+    def prepare(self, preprocessor, force=False, batchPreprocessor=None):
         self.preprocessor = preprocessor
+        self.batchPreprocessor = batchPreprocessor
         self.force_build = force
-        with Pool(num_workers) as p:
-            N = len(self.dataset)
-            _ = list(tqdm(p.imap(self.storeFeature, range(N)), total=N))
 
-    def storeFeature(self, i):
-        # <ddir>/<orig_name>-<id>.pkl
-        pklPath = self.getPklPath(i)
-        if (not os.path.exists(pklPath)) or self.force_build:
-            feature = self.preprocessor(self.dataset.pathPairs[i].wav)
-            with open(pklPath, "wb") as f:
-                pickle.dump(feature, f, pickle.HIGHEST_PROTOCOL)
+    def needBuild(self, i):
+        return (not self.hasFeature(i)) or self.force_build
 
-    def loadFeature(self, i):
-        # <ddir>/<orig_name>-<id>.pkl
-        pklPath = self.getPklPath(i)
-        try:
-            with open(pklPath, "rb") as f:
-                feature = pickle.load(f)
-            return feature
-        except FileNotFoundError as e:
-            logger.error(f'file "{pklPath}" not found, build the dataset first.')
-            raise e
+    def hasFeature(self, i, wavPath=None):
+        if self.store is not None:
+            return self.getFeatureKey(i, wavPath=wavPath) in self.store
+        return os.path.exists(self.getFeaturePath(i, wavPath=wavPath))
 
-    def getPklPath(self, idx, wavPath=None):
+    def storeFeature(self, i):
+        """returns whether the feature of song i is stored, a failing song is
+        retried BUILD_RETRIES times and recorded in the manifest"""
+        if not self.needBuild(i):
+            return True
+        wavPath = self.dataset.pathPairs[i].wav
+        # elapsed time of all the attempts
+        start = time.time()
+        for attempt in range(1, BUILD_RETRIES + 2):
+            try:
+                self.dumpFeature(i, self.preprocessor(wavPath))
+            except Exception as e:
+                logger.error(f"building {wavPath} failed, attempt={attempt}: {e!r}")
+                error = repr(e)
+            else:
+                self.record(i, "done", time.time() - start, attempt)
+                return True
+        self.record(i, "failed", time.time() - start, attempt, error)
+        return False
+
+    def storeBatch(self, indices):
+        """returns the indices that could not be built"""
+        if self.batchPreprocessor is not None and len(indices) > 1:
+            wavPaths = [self.dataset.pathPairs[i].wav for i in indices]
+            start = time.time()
+            try:
+                features = self.batchPreprocessor(wavPaths)
+            except Exception as e:
+                # isolate the failing song
+                logger.warn(f"batch of {len(indices)} songs failed, one by one: {e!r}")
+            else:
+                elapsed = (time.time() - start) / len(indices)
+                failed = []
+                for i, wavPath, feature in zip(indices, wavPaths, features):
+                    try:
+                        self.dumpFeature(i, feature)
+                    except Exception as e:
+                        # retried one by one
+                        logger.error(f"storing {wavPath} failed: {e!r}")
+                        failed.append(i)
+                    else:
+                        self.record(i, "done", elapsed, 1)
+                indices = failed
+        return [i for i in indices if not self.storeFeature(i)]
+
+    def record(self, i, status, elapsed, attempts, error=None):
+        # one line per build attempt, appended by all the workers
+        entry = {
+            "key": self.getFeatureKey(i),
+            "title": self.dataset.pathPairs[i].title,
+            "status": status,
+            "elapsed": round(elapsed, 3),
+            "attempts": attempts,
+            "error": error,
+        }
+        with open(self.getManifestPath(), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def manifest(self):
+        """{feature key: latest build entry}"""
+        entries = {}
+        if os.path.exists(self.getManifestPath()):
+            with open(self.getManifestPath()) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    entries[entry["key"]] = entry
+        return entries
+
+    def getManifestPath(self):
+        return os.path.join(self.ddir, f"{self.tid}.manifest")
+
+    def dumpFeature(self, i, feature):
+        """a feature is written under a temporary name and renamed, readers
+        never see a partial file"""
+        tmpSuffix = f".tmp-{os.getpid()}"
+        if self.store is not None:
+            self.store.put(self.getFeatureKey(i), feature)
+            return
+        if FEATURE_STORE != "npy":
+            pklPath = self.getPklPath(i)
+            with open(pklPath + tmpSuffix, "wb") as f:
+                pickle.dump(feature, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(pklPath + tmpSuffix, pklPath)
+            return
+        # numeric arrays as raw .npy files, everything else (cliques, sparse
+        # matrices) in a pickle next to them
+        fdir = self.getFeaturePath(i)
+        tmpDir = fdir + tmpSuffix
+        if os.path.exists(tmpDir):
+            shutil.rmtree(tmpDir)
+        os.mkdir(tmpDir)
+        rest = {}
+        for key, value in feature.items():
+            if isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(tmpDir, f"{key}.npy"), value)
+            else:
+                rest[key] = value
+        if rest:
+            with open(os.path.join(tmpDir, "rest.pkl"), "wb") as f:
+                pickle.dump(rest, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(fdir):
+            # a directory can't be replaced, the old one is moved away first
+            os.rename(fdir, fdir + tmpSuffix + "-old")
+            os.rename(tmpDir, fdir)
+            shutil.rmtree(fdir + tmpSuffix + "-old")
+        else:
+            os.rename(tmpDir, fdir)
+
+    def loadFeature(self, i, wavPath=None):
+        """arrays of the npy and shard stores are read-only memory maps, only
+        the pages a reader touches are read from the disk"""
+        if self.store is not None:
+            key = self.getFeatureKey(i, wavPath=wavPath)
+            try:
+                return self.store.get(key)
+            except KeyError as e:
+                logger.error(
+                    f'key "{key}" not in "{self.store.root}", build the dataset first.'
+                )
+                raise e
+        fpath = self.getFeaturePath(i, wavPath=wavPath)
+        if not os.path.exists(fpath):
+            logger.error(f'file "{fpath}" not found, build the dataset first.')
+            raise FileNotFoundError(fpath)
+        if FEATURE_STORE != "npy":
+            with open(fpath, "rb") as f:
+                return pickle.load(f)
+        feature = {}
+        for filename in os.listdir(fpath):
+            key, ext = os.path.splitext(filename)
+            if ext == ".npy":
+                feature[key] = np.load(os.path.join(fpath, filename), mmap_mode="r")
+            elif filename == "rest.pkl":
+                with open(os.path.join(fpath, filename), "rb") as f:
+                    feature.update(pickle.load(f))
+        return feature
+
+    def getFeaturePath(self, idx, wavPath=None):
+        if FEATURE_STORE != "npy":
+            return self.getPklPath(idx, wavPath=wavPath)
+        return os.path.splitext(self.getPklPath(idx, wavPath=wavPath))[0]
+
+    def getFeatureKey(self, idx, wavPath=None):
         if wavPath is None:
             wavPath = self.dataset.pathPairs[idx].wav
         _, filename = os.path.split(wavPath)
         orig_name, _ = os.path.splitext(filename)
-        new_path = os.path.join(self.ddir, f"{orig_name}-{self.tid}.pkl")
-        return new_path
+        # the content hash tells apart the same filename in different folders
+        return f"{orig_name}-{audioHash(wavPath)}"
+
+    def getPklPath(self, idx, wavPath=None):
+        key = self.getFeatureKey(idx, wavPath=wavPath)
+        return os.path.join(self.ddir, f"{key}-{self.tid}.pkl")
+
+    def compact(self):
+        # drop the records overwritten by forced rebuilds
+        if self.store is not None:
+            self.store.compact()
 
     def __len__(self):
         return len(self.dataset)
@@ -505,10 +715,117 @@ class Preprocess_Dataset:
 
 def buildPreprocessDataset(dataset, tf, force=False):
     preDataset = Preprocess_Dataset(tf.identifier, dataset)
-    preDataset.build(tf.preprocessor, force=force)
+    preDataset.build(
+        tf.preprocessor,
+        force=force,
+        batchPreprocessor=getattr(tf, "batchPreprocessor", None),
+        batchSongs=MELODY_BATCH_SONGS,
+    )
     return preDataset
 
 
+def _storeStage(stages, tid, indices):
+    return stages[tid].storeBatch(indices)
+
+
+def buildPipeline(
+    dataset,
+    transforms,
+    force=False,
+    num_workers=NUM_WORKERS,
+    batchSongs=MELODY_BATCH_SONGS,
+):
+    """builds the Preprocess_Datasets of several transforms in one pool, a song goes
+    on to a stage as soon as the stages it requires are stored for it, instead of
+    waiting for the whole dataset after every stage"""
+    stages = {}
+    for tf in transforms:
+        stage = Preprocess_Dataset(tf.identifier, dataset)
+        stage.prepare(tf.preprocessor, force, getattr(tf, "batchPreprocessor", None))
+        stages[tf.identifier] = stage
+    order = list(stages)
+    requires = {
+        tf.identifier: [tid for tid in tf.requires() if tid in stages]
+        for tf in transforms
+    }
+    logger.info(
+        f"building <{dataset.__class__.__name__}> through the stages <{', '.join(order)}>"
+    )
+    # todo: stages not stored yet, waiting: stages not submitted yet, of every song
+    todo = [
+        {tid for tid in order if stages[tid].needBuild(i)} for i in range(len(dataset))
+    ]
+    waiting = [set(stageSet) for stageSet in todo]
+    waitingCount = {tid: sum(tid in w for w in waiting) for tid in order}
+    ready = {tid: [] for tid in order}
+    done = queue.Queue()
+
+    failed = [set() for _ in range(len(dataset))]
+
+    def release(i):
+        for tid in order:
+            if tid not in waiting[i]:
+                continue
+            if any(r in failed[i] for r in requires[tid]):
+                # the input of the stage is missing, the stage fails too
+                waiting[i].remove(tid)
+                waitingCount[tid] -= 1
+                failed[i].add(tid)
+                bar.update(1)
+            elif not any(r in todo[i] for r in requires[tid]):
+                waiting[i].remove(tid)
+                waitingCount[tid] -= 1
+                ready[tid].append(i)
+
+    def nextTask():
+        # later stages first, they complete songs instead of starting new ones
+        for tid in reversed(order):
+            size = 1 if stages[tid].batchPreprocessor is None else batchSongs
+            # a partial batch only when no other song can join it
+            if len(ready[tid]) >= size or (ready[tid] and waitingCount[tid] == 0):
+                indices, ready[tid] = ready[tid][:size], ready[tid][size:]
+                return tid, indices
+        return None
+
+    # the workers hold the stages, a task is only a stage identifier and song indices
+    pool = residentPool(partial(_storeStage, stages), num_workers)
+    with pool as p, tqdm(total=sum(map(len, todo))) as bar:
+        # longest songs first, the short ones fill the idle workers at the end
+        durations = dataset.getWeights()
+        for i in sorted(range(len(dataset)), key=lambda i: durations[i], reverse=True):
+            release(i)
+        running = 0
+        while True:
+            task = nextTask() if running < num_workers else None
+            while task is not None:
+                p.apply_async(
+                    callResident,
+                    task,
+                    callback=lambda res, t=task: done.put((t, res, None)),
+                    error_callback=lambda e, t=task: done.put((t, None, e)),
+                )
+                running += 1
+                task = nextTask() if running < num_workers else None
+            if running == 0:
+                break
+            (tid, indices), stageFailed, error = done.get()
+            running -= 1
+            if error is not None:
+                raise error
+            for i in indices:
+                todo[i].remove(tid)
+                if i in stageFailed:
+                    failed[i].add(tid)
+                release(i)
+            bar.update(len(indices))
+    numFailed = sum(len(f) > 0 for f in failed)
+    if numFailed:
+        logger.warn(
+            f"{numFailed} songs failed, see the manifests in {stages[order[0]].ddir}, building again retries them"
+        )
+    return [stages[tid] for tid in order]
+
+
 class DummyDataset(BaseStructDataset):
     def __init__(self, audioList):
         super(DummyDataset, self).__init__(baseDir=None, transform=None)
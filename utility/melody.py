@@ -0,0 +1,106 @@
+import os
+import atexit
+import pickle
+import subprocess
+
+from configs.configs import (
+    ALGO_BASE_DIRS,
+    MELODY_BATCH_SIZE,
+    MELODY_CHUNK_WINDOWS,
+    logger,
+)
+
+SERVER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "melodyServer.py"
+)
+MELODY_MODULES = {
+    "SSL": "melodyExtraction_NS",
+    "JDC": "melodyExtraction_JDC",
+}
+
+
+class MelodyWorker:
+    """melody extraction model kept resident in a local subprocess,
+    songs are sent one after another and the model is loaded only once"""
+
+    def __init__(self, algo):
+        self.algo = algo
+        self.proc = None
+        self.pid = None
+
+    def start(self):
+        logger.info(f"starting melody extraction worker <{self.algo}>")
+        commands = (
+            "python",
+            SERVER_SCRIPT,
+            ALGO_BASE_DIRS[self.algo],
+            MELODY_MODULES[self.algo],
+        )
+        self.proc = subprocess.Popen(
+            commands, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        # a forked process must not share the pipes of its parent
+        self.pid = os.getpid()
+
+    def alive(self):
+        return (
+            self.proc is not None
+            and self.pid == os.getpid()
+            and self.proc.poll() is None
+        )
+
+    def __call__(self, wavPath, signal=None):
+        return self.batch([wavPath], [signal])[0]
+
+    def batch(
+        self,
+        wavPaths,
+        signals=None,
+        batch_size=MELODY_BATCH_SIZE,
+        chunk_windows=MELODY_CHUNK_WINDOWS,
+    ):
+        """the windows of all the songs share the predict batches, returns [(times, pitches)]
+        songs longer than <chunk_windows> windows are streamed in chunks with bounded memory
+        """
+        if not self.alive():
+            self.start()
+        if signals is None:
+            signals = [None] * len(wavPaths)
+        request = {
+            "wavPaths": wavPaths,
+            "signals": signals,
+            "batch_size": batch_size,
+            "chunk_windows": chunk_windows,
+        }
+        pickle.dump(request, self.proc.stdin, pickle.HIGHEST_PROTOCOL)
+        self.proc.stdin.flush()
+        try:
+            response = pickle.load(self.proc.stdout)
+        except EOFError:
+            raise RuntimeError(
+                f"melody extraction worker <{self.algo}> exited with {self.proc.wait()}"
+            )
+        if "error" in response:
+            raise RuntimeError(f"melody extraction failed: {response['error']}")
+        return response["melodies"]
+
+    def close(self):
+        if self.alive():
+            self.proc.stdin.close()
+            self.proc.wait()
+        self.proc = None
+
+
+_workers = {}  # key:algorithm value:MelodyWorker of this process
+
+
+def getMelodyWorker(algo):
+    if algo not in _workers:
+        _workers[algo] = MelodyWorker(algo)
+    return _workers[algo]
+
+
+@atexit.register
+def closeMelodyWorkers():
+    for worker in _workers.values():
+        worker.close()
@@ -0,0 +1,46 @@
+"""long-lived melody extraction process, started by utility.melody.MelodyWorker
+usage: python melodyServer.py <algorithm directory> <module name>
+requests {"wavPaths", "signals", "batch_size", "chunk_windows"} and responses {"melodies": [(times, pitches)]}
+or {"error"} are pickled one after another on stdin/stdout"""
+
+import os
+import sys
+import pickle
+import importlib
+import traceback
+
+
+def serve(algoDir, moduleName):
+    # the extractors import their modules and load the weights relative to their directory
+    os.chdir(algoDir)
+    sys.path.insert(0, algoDir)
+    # stdout is kept for the responses, prints and progress bars go to stderr
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    requests = sys.stdin.buffer
+
+    module = importlib.import_module(moduleName)
+    model = module.loadModel()
+    while True:
+        try:
+            request = pickle.load(requests)
+        except EOFError:
+            # the client closed the pipe
+            break
+        try:
+            melodies = module.predictMelodyBatch(
+                model,
+                request["wavPaths"],
+                ys=request["signals"],
+                batch_size=request["batch_size"],
+                chunk_windows=request["chunk_windows"],
+            )
+            response = {"melodies": melodies}
+        except Exception:
+            response = {"error": traceback.format_exc()}
+        pickle.dump(response, responses, pickle.HIGHEST_PROTOCOL)
+        responses.flush()
+
+
+if __name__ == "__main__":
+    serve(*sys.argv[1:3])
@@ -6,10 +6,10 @@ from copy import deepcopy
 import matplotlib
 import matplotlib.pyplot as plt
 from mir_eval import segment, transcription
-from multiprocessing import Pool
 
 from tqdm import tqdm
 
+from utility.parallel import scheduledMap
 from utility.common import (
     extractFunctions,
     filterIntvs,
@@ -39,15 +39,21 @@ class AlgoEvaluator:
         return metric
 
     def __call__(self):
+        N = len(self.dataset)
         try:
-            with Pool(self.num_workers) as p:
-                N = len(self.dataset)
-                metrics = list(tqdm(p.imap(self.eval, range(N)), total=N))
+            # the workers hold the algorithm and the dataset, tasks are song indices
+            metrics = scheduledMap(
+                self.eval,
+                [(i,) for i in range(N)],
+                weights=self.dataset.getWeights(),
+                num_workers=self.num_workers,
+            )
         except RuntimeError as e:
             # CUDA RuntimeError
             metrics = [self.eval(i) for i in tqdm(range(N))]
             logger.error(f"[RuntimeError] ", e)
-        titles = [sample["title"] for sample in self.dataset]
+        # the titles without loading the samples
+        titles = [pair.title for pair in self.dataset.pathPairs]
         return np.array(metrics), titles
 
 
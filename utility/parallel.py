@@ -0,0 +1,42 @@
+from multiprocessing import Pool
+from tqdm import tqdm
+
+from configs.configs import NUM_WORKERS
+
+# callable installed once in every worker process by the pool initializer
+_resident = None
+
+
+def _setResident(fun):
+    global _resident
+    _resident = fun
+
+
+def callResident(*args):
+    return _resident(*args)
+
+
+def _callIndexed(task):
+    i, args = task
+    return i, _resident(*args)
+
+
+def residentPool(fun, num_workers=NUM_WORKERS):
+    """pool whose workers receive <fun> (and the heavy objects it holds) once,
+    tasks submitted with callResident only carry their arguments"""
+    return Pool(num_workers, initializer=_setResident, initargs=(fun,))
+
+
+def scheduledMap(fun, tasks, weights=None, num_workers=NUM_WORKERS):
+    """[fun(*task) for task in tasks] in a resident pool, the heaviest tasks
+    (e.g. the longest songs) start first so the short ones fill the idle
+    workers at the end"""
+    order = list(range(len(tasks)))
+    if weights is not None:
+        order.sort(key=lambda i: weights[i], reverse=True)
+    results = [None] * len(tasks)
+    with residentPool(fun, num_workers) as p:
+        taskIter = p.imap_unordered(_callIndexed, [(i, tasks[i]) for i in order])
+        for i, res in tqdm(taskIter, total=len(tasks)):
+            results[i] = res
+    return results
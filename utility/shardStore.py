@@ -0,0 +1,176 @@
+import os
+import json
+import fcntl
+import pickle
+import zlib
+import numpy as np
+from contextlib import contextmanager
+
+from configs.configs import SHARD_COUNT, logger
+
+# records start at multiples of this, arrays are mapped with their natural alignment
+ALIGN = 64
+COPY_BLOCK = 1 << 22
+
+
+class ShardStore:
+    """a few large append-only shard files and a key -> offset index
+
+    <root>/shard-<k>.bin    records of the keys hashed to shard k
+    <root>/shard-<k>.idx    one json line per record, the last line of a key wins
+    <root>/shard-<k>.lock   appends and compaction hold it exclusively, reads shared
+    numeric arrays are stored raw and loaded as read-only memory maps,
+    other values are pickled
+    """
+
+    def __init__(self, root, num_shards=SHARD_COUNT):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        # the shard count of an existing store wins over the configured one
+        meta = os.path.join(root, "shards.json")
+        if os.path.exists(meta):
+            with open(meta) as f:
+                num_shards = json.load(f)["shards"]
+        else:
+            with open(meta, "w") as f:
+                json.dump({"shards": num_shards}, f)
+        self.num_shards = num_shards
+        self._indices = {}  # shard -> (inode, size read, {key: fields})
+
+    def shardOf(self, key):
+        return zlib.crc32(key.encode("utf-8")) % self.num_shards
+
+    def path(self, shard, ext):
+        return os.path.join(self.root, f"shard-{shard}.{ext}")
+
+    @contextmanager
+    def lock(self, shard, mode):
+        with open(self.path(shard, "lock"), "a") as f:
+            fcntl.flock(f, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def index(self, shard):
+        """{key: fields} of a shard, only the lines appended since the last call are parsed"""
+        idxPath = self.path(shard, "idx")
+        try:
+            st = os.stat(idxPath)
+        except FileNotFoundError:
+            return {}
+        inode, size, index = self._indices.get(shard, (None, 0, None))
+        if inode != st.st_ino or st.st_size < size:
+            size, index = 0, {}
+        if st.st_size > size:
+            with open(idxPath, "rb") as f:
+                f.seek(size)
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn line of an interrupted append
+                        continue
+                    index[entry["key"]] = entry["fields"]
+        self._indices[shard] = (st.st_ino, st.st_size, index)
+        return index
+
+    def __contains__(self, key):
+        shard = self.shardOf(key)
+        with self.lock(shard, fcntl.LOCK_SH):
+            return key in self.index(shard)
+
+    def keys(self):
+        keys = []
+        for shard in range(self.num_shards):
+            with self.lock(shard, fcntl.LOCK_SH):
+                keys.extend(self.index(shard).keys())
+        return keys
+
+    def put(self, key, feature):
+        """append a dict of values, replaces the previous record of the key"""
+        shard = self.shardOf(key)
+        with self.lock(shard, fcntl.LOCK_EX):
+            fields = {}
+            with open(self.path(shard, "bin"), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                for name, value in feature.items():
+                    pad = -offset % ALIGN
+                    f.write(b"\0" * pad)
+                    offset += pad
+                    if isinstance(value, np.ndarray) and value.dtype != object:
+                        value = np.ascontiguousarray(value)
+                        loc = {"dtype": value.dtype.str, "shape": value.shape}
+                        data = value.reshape(-1).view(np.uint8)
+                    else:
+                        loc = {}
+                        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+                    f.write(data)
+                    loc.update(offset=offset, length=len(data))
+                    fields[name] = loc
+                    offset += len(data)
+            # the index line is written after its data, a crash leaves unindexed bytes
+            with open(self.path(shard, "idx"), "ab+") as f:
+                if f.seek(0, os.SEEK_END) > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        f.write(b"\n")
+                f.write(json.dumps({"key": key, "fields": fields}).encode() + b"\n")
+
+    def readFields(self, f, fields):
+        feature = {}
+        for name, loc in fields.items():
+            if "dtype" in loc:
+                shape, dtype = tuple(loc["shape"]), np.dtype(loc["dtype"])
+                if loc["length"] == 0:
+                    feature[name] = np.empty(shape, dtype=dtype)
+                    continue
+                feature[name] = np.memmap(
+                    f, dtype=dtype, mode="r", offset=loc["offset"], shape=shape
+                )
+            else:
+                f.seek(loc["offset"])
+                feature[name] = pickle.loads(f.read(loc["length"]))
+        return feature
+
+    def get(self, key):
+        shard = self.shardOf(key)
+        with self.lock(shard, fcntl.LOCK_SH):
+            fields = self.index(shard).get(key)
+            if fields is None:
+                raise KeyError(key)
+            with open(self.path(shard, "bin"), "rb") as f:
+                return self.readFields(f, fields)
+
+    def compact(self):
+        """rewrite the shards with the latest record of every key, returns the bytes reclaimed"""
+        reclaimed = 0
+        for shard in range(self.num_shards):
+            binPath = self.path(shard, "bin")
+            with self.lock(shard, fcntl.LOCK_EX):
+                if not os.path.exists(binPath):
+                    continue
+                index = self.index(shard)
+                before = os.path.getsize(binPath)
+                with open(binPath, "rb") as src, open(
+                    binPath + ".tmp", "wb"
+                ) as dst, open(self.path(shard, "idx") + ".tmp", "w") as idx:
+                    for key, fields in index.items():
+                        for loc in fields.values():
+                            dst.write(b"\0" * (-dst.tell() % ALIGN))
+                            src.seek(loc["offset"])
+                            loc["offset"] = dst.tell()
+                            remaining = loc["length"]
+                            while remaining > 0:
+                                block = src.read(min(remaining, COPY_BLOCK))
+                                dst.write(block)
+                                remaining -= len(block)
+                        idx.write(json.dumps({"key": key, "fields": fields}) + "\n")
+                    after = dst.tell()
+                # open memory maps keep the replaced files alive
+                os.replace(binPath + ".tmp", binPath)
+                os.replace(self.path(shard, "idx") + ".tmp", self.path(shard, "idx"))
+                self._indices.pop(shard, None)
+            reclaimed += before - after
+        logger.info(f"compacted store={self.root}, reclaimed {reclaimed} bytes")
+        return reclaimed
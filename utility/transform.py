@@ -1,31 +1,71 @@
-import librosa
 import subprocess
 from third_party import msaf
 import os
-import pickle
 import numpy as np
-from mir_eval.io import load_time_series
 from collections import defaultdict
+from functools import lru_cache
 
 from models.selfSimilarity import selfSimilarityMatrix
 from models.seqRecur import cliquesFromSSM
-from utility.common import extractFunctions, cliqueGroups, logSSM
+from utility.audio import getDuration, melodySignal
+from utility.common import (
+    configFingerprint,
+    decodeSSM,
+    encodeSSM,
+    extractFunctions,
+    cliqueGroups,
+    logSSM,
+)
 from utility.dataset import Preprocess_Dataset
+from utility.melody import getMelodyWorker
 from configs.modelConfigs import (
     CLI_TRANSFORM_IDENTIFIER,
+    EPSILON,
+    FUSION_DTYPE,
+    MEL_SAMPLE_RATE,
     MEL_SEMANTIC_LABEL_DIC,
     MEL_TRANSFORM_IDENTIFIER,
+    PITCH_CHROMA_CLASS,
+    PITCH_CHROMA_COUNT,
+    PITCH_CHROMA_HOP,
+    REC_SMOOTH,
     SAMPLE_RATE,
     SSM_FEATURES,
+    SSM_FFT_CHROMA,
+    SSM_REDUCE_DIM,
+    SSM_REDUCE_METHOD,
+    SSM_REDUCE_SEED,
+    SSM_SPARSE,
+    SSM_SPARSE_BAND,
+    SSM_SPARSE_NEIGHBORS,
+    SSM_STORE_COMPRESS,
+    SSM_STORE_DTYPE,
+    SSM_STORE_TOLERANCE,
     SSM_TRANSFORM_IDENTIFIER,
     SSM_USING_MELODY,
 )
-from configs.configs import logger, ALGO_BASE_DIRS
+from configs.configs import (
+    MELODY_CHUNK_WINDOWS,
+    MELODY_WORKER,
+    SSM_THREADS,
+    logger,
+    ALGO_BASE_DIRS,
+)
 
 
 class BaseTransform:
     def __init__(self, identifier):
-        self.identifier = identifier
+        # features are cached under the identifier and a fingerprint of the
+        # configuration they were computed with, stale caches are never reused
+        self.identifier = f"{identifier}-{configFingerprint(self.config())}"
+
+    def config(self):
+        """constants the output of the preprocessor depends on"""
+        return {}
+
+    def requires(self):
+        """identifiers of the transforms whose stored features the preprocessor reads"""
+        return []
 
     def preprocessor(self, wavPath, sr):
         raise NotImplementedError
@@ -35,9 +75,14 @@ class BaseTransform:
 
 
 class GenerateSSM(BaseTransform):
-    def __init__(self, dataset, identifier=SSM_TRANSFORM_IDENTIFIER):
+    def __init__(
+        self, dataset, identifier=SSM_TRANSFORM_IDENTIFIER, num_threads=SSM_THREADS
+    ):
+        self.melTransform = ExtractMel()
         super(GenerateSSM, self).__init__(identifier)
-        tf = ExtractMel()
+        # threads of the per-modality branches inside each worker process
+        self.num_threads = num_threads
+        tf = self.melTransform
         self.mel_set = Preprocess_Dataset(
             tf.identifier, dataset, transform=tf.transform
         )
@@ -45,91 +90,202 @@ class GenerateSSM(BaseTransform):
         self.labelDic = defaultdict(int, dataset.semanticLabelDic())
         assert self.labelDic["background"] == 0
 
+    def config(self):
+        return {
+            "mel": self.melTransform.identifier if SSM_USING_MELODY else None,
+            "sr": SAMPLE_RATE,
+            "features": tuple(SSM_FEATURES),
+            "recSmooth": REC_SMOOTH,
+            "fusionDtype": np.dtype(FUSION_DTYPE).name,
+            "fftChroma": SSM_FFT_CHROMA,
+            "pitchChroma": (PITCH_CHROMA_CLASS, PITCH_CHROMA_COUNT, PITCH_CHROMA_HOP),
+            "sparse": (SSM_SPARSE_NEIGHBORS, SSM_SPARSE_BAND) if SSM_SPARSE else None,
+            "reduce": (
+                (SSM_REDUCE_DIM, SSM_REDUCE_METHOD, SSM_REDUCE_SEED)
+                if SSM_REDUCE_DIM is not None
+                else None
+            ),
+            "domain": "log",
+            "store": (
+                np.dtype(SSM_STORE_DTYPE).name,
+                SSM_STORE_COMPRESS,
+                SSM_STORE_TOLERANCE,
+            ),
+        }
+
+    def requires(self):
+        return [self.melTransform.identifier] if SSM_USING_MELODY else []
+
     def getSSM(self, wavPath, sr):
         if SSM_USING_MELODY:
-            pklPath = self.mel_set.getPklPath(-1, wavPath=wavPath)
-            assert os.path.exists(
-                pklPath
-            ), f"{pklPath} not found, build GenerateSSM Preprocess_Dataset first"
-            with open(pklPath, "rb") as f:
-                mel = pickle.load(f)
+            mel = self.mel_set.loadFeature(-1, wavPath=wavPath)
             mel = (mel["times"], mel["pitches"])
-            res = selfSimilarityMatrix(wavPath, mel=mel)
+            res = selfSimilarityMatrix(wavPath, mel=mel, num_threads=self.num_threads)
         else:
-            res = selfSimilarityMatrix(wavPath)
+            res = selfSimilarityMatrix(wavPath, num_threads=self.num_threads)
         times = res["times"]
         mat = res["Ws"]
         # ['MFCCs', 'Chromas', 'Tempogram'] [Fused] ['Fused MFCC/Chroma'] ['Melody']
         ssm_features = [mat[key] for key in SSM_FEATURES]
-        ssm = np.stack(ssm_features, axis=0)
+        # sparse matrices are kept in a list
+        ssm = np.stack(ssm_features, axis=0) if not SSM_SPARSE else ssm_features
         return times, ssm
 
     def preprocessor(self, wavPath, sr=SAMPLE_RATE):
         times, ssm = self.getSSM(wavPath, sr)
-        dur = librosa.get_duration(filename=wavPath)
+        dur = getDuration(wavPath)
         assert abs(times[-1] - dur) < 0.1, f"{times[-1]} != {dur}"
         times[-1] = dur
         assert (np.diff(times, n=2) < 0.3).all(), f"{np.diff(times)[-3:]}"
-        assert len(times) == ssm.shape[-1] + 1, f"{len(times)}, {ssm.shape}"
+        assert len(times) == ssm[0].shape[-1] + 1, f"{len(times)}, {ssm[0].shape}"
+        # stored in log domain, readers use the matrices as they are loaded
+        ssm = encodeSSM(logSSM(ssm)) if not SSM_SPARSE else list(map(logSSM, ssm))
         return {"times": times, "ssm": ssm}
 
     def transform(self, sample):
         feature = sample["feature"]
-        times, ssm = feature["times"], feature["ssm"]
+        times, ssm = feature["times"], decodeSSM(feature["ssm"])
         intervals, labels = sample["gt"]
-        # generate target label matrix
-        size = ssm.shape[-1]
-        target = np.full((size, size), self.labelDic["background"])
-        for label in self.labelSet:
+        # label of every frame, the target matrix is built from it on access
+        size = len(times) - 1
+        frameLabels = np.full(size, -1)
+        for i, label in enumerate(self.labelSet):
+            # left	a[i-1] < v <= a[i]
+            # right	a[i-1] <= v < a[i]
             intvs = intervals[labels == label]
-            for xbegin, xend in intvs:
-                # left	a[i-1] < v <= a[i]
-                # right	a[i-1] <= v < a[i]
-                xlower = np.searchsorted(times, xbegin)
-                xhigher = np.searchsorted(times, xend)
-                for ybegin, yend in intvs:
-                    ylower = np.searchsorted(times, ybegin)
-                    yhigher = np.searchsorted(times, yend)
-                    target[xlower:xhigher, ylower:yhigher] = self.labelDic[label]
-
-        sample["input"] = logSSM(ssm)
-        sample["target"] = target
+            if len(intvs) == 0:
+                continue
+            lower = np.searchsorted(times, intvs[:, 0])
+            higher = np.searchsorted(times, intvs[:, 1])
+            for xlower, xhigher in zip(lower, higher):
+                frameLabels[xlower:xhigher] = i
+        background = self.labelDic["background"]
+        # unlabeled frames (-1) index the trailing background
+        labelIds = np.array([self.labelDic[lb] for lb in self.labelSet] + [background])
+
+        sample["input"] = ssm
+        sample["target"] = TargetMatrix(frameLabels, labelIds[frameLabels], background)
         sample["times"] = times
         sample.pop("feature")
         return sample
 
 
+class TargetMatrix:
+    """target label matrix of the ssm, [i, j] is the label id of frame i if
+    frames i and j have the same label, background otherwise.
+    block encoded by the per-frame labels, numpy indexing or np.asarray build
+    only the requested part"""
+
+    def __init__(self, frameLabels, frameIds, background):
+        self.frameLabels = frameLabels
+        self.frameIds = frameIds
+        self.background = background
+        self.shape = (len(frameLabels), len(frameLabels))
+        self.ndim = 2
+
+    def diagonal(self):
+        return self.frameIds
+
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        same = np.equal.outer(self.frameLabels[rows], self.frameLabels[cols])
+        ids = self.frameIds[rows]
+        ids = np.reshape(ids, np.shape(ids) + (1,) * (same.ndim - np.ndim(ids)))
+        return np.where(same, ids, self.background)[()]
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:, :] if dtype is None else self[:, :].astype(dtype)
+
+
 class ExtractMel(BaseTransform):
     def __init__(self, identifier=MEL_TRANSFORM_IDENTIFIER):
         super(ExtractMel, self).__init__(identifier)
 
+    def config(self):
+        # the chunked and batched inference give the same melody, not included
+        return {"algo": "SSL", "sr": MEL_SAMPLE_RATE}
+
+    def dumpSignal(self, wavPath, output):
+        # decoded here, the extractor reads it instead of the audio file
+        signalPath = f"{os.path.splitext(output)[0]}_{MEL_SAMPLE_RATE}.npy"
+        np.save(signalPath, melodySignal(wavPath))
+        return signalPath
+
+    def extractResident(self, algo, wavPath):
+        return self.extractResidentBatch(algo, [wavPath])[0]
+
+    def extractResidentBatch(self, algo, wavPaths):
+        # model loaded once per process, no temporary files
+        signals = [melodySignal(wavPath) for wavPath in wavPaths]
+        melodies = getMelodyWorker(algo).batch(wavPaths, signals)
+        return [{"times": times, "pitches": pitches} for times, pitches in melodies]
+
+    def loadMelody(self, output):
+        # [<frame>, (time, pitch)] written by the extractors
+        melody = np.load(output)
+        os.remove(output)
+        return {"times": melody[:, 0], "pitches": melody[:, 1]}
+
     def JDC(self, wavPath, output, sr=SAMPLE_RATE):
         """<Joint Detection and Classification of Singing Voice Melody Using Convolutional Recurrent Neural Networks>"""
-        commands = ("python", "./melodyExtraction_JDC.py", wavPath, output)
+        if MELODY_WORKER:
+            return self.extractResident("JDC", wavPath)
+        signalPath = self.dumpSignal(wavPath, output)
+        commands = (
+            "python",
+            "./melodyExtraction_JDC.py",
+            wavPath,
+            output,
+            "--signal",
+            signalPath,
+            "--chunk-windows",
+            str(MELODY_CHUNK_WINDOWS),
+        )
         ret = subprocess.call(commands, cwd=ALGO_BASE_DIRS["JDC"])
+        os.remove(signalPath)
         assert ret == 0, f"return value: {ret} != 0"
-        times, pitches = load_time_series(output, delimiter=r"\s+|,")
-        return {"times": times, "pitches": pitches}
+        return self.loadMelody(output)
 
     def SSL(self, wavPath, output, sr=SAMPLE_RATE):
         """<Semi-supervised learning using teacher-student models for vocal melody extraction>"""
+        if MELODY_WORKER:
+            return self.extractResident("SSL", wavPath)
         dirname = os.path.dirname(output)
-        output = f"pitch_{os.path.basename(wavPath)}.txt"
+        output = f"pitch_{os.path.basename(wavPath)}.npy"
         output = os.path.join(dirname, output)
-        commands = ("python", "./melodyExtraction_NS.py", "-p", wavPath, "-o", dirname)
+        signalPath = self.dumpSignal(wavPath, output)
+        commands = (
+            "python",
+            "./melodyExtraction_NS.py",
+            "-p",
+            wavPath,
+            "-o",
+            dirname,
+            "-s",
+            signalPath,
+            "-c",
+            str(MELODY_CHUNK_WINDOWS),
+        )
         logger.debug(f"SSL commands={commands}")
         ret = subprocess.call(commands, cwd=ALGO_BASE_DIRS["SSL"])
+        os.remove(signalPath)
         assert ret == 0, f"return value: {ret} != 0"
-        times, pitches = load_time_series(output, delimiter=r"\s+|,")
-        return {"times": times, "pitches": pitches}
+        return self.loadMelody(output)
 
     def preprocessor(self, wavPath, sr=SAMPLE_RATE):
         wavPath = os.path.abspath(wavPath)
         title = os.path.splitext(os.path.basename(wavPath))[0]
-        tmpMel = os.path.join(ALGO_BASE_DIRS["TmpDir"], f"{title}_JDC_out.csv")
+        tmpMel = os.path.join(ALGO_BASE_DIRS["TmpDir"], f"{title}_JDC_out.npy")
         logger.debug(f"convert wav={wavPath} to mel={tmpMel}")
         return self.SSL(wavPath, tmpMel)
 
+    def batchPreprocessor(self, wavPaths):
+        """several songs share the batches of the model inference"""
+        if MELODY_WORKER:
+            wavPaths = [os.path.abspath(wavPath) for wavPath in wavPaths]
+            return self.extractResidentBatch("SSL", wavPaths)
+        return [self.preprocessor(wavPath) for wavPath in wavPaths]
+
     def transform(self, sample):
         feature = sample["feature"]
         times, pitches = feature["times"], feature["pitches"]
@@ -153,20 +309,21 @@ class ExtractMel(BaseTransform):
 
 class ExtractCliques(BaseTransform):
     def __init__(self, dataset, identifier=CLI_TRANSFORM_IDENTIFIER):
-        super(ExtractCliques, self).__init__(identifier)
         self.tf = GenerateSSM(dataset=dataset)
+        super(ExtractCliques, self).__init__(identifier)
         self.ssm_set = Preprocess_Dataset(
             self.tf.identifier, dataset, transform=self.tf.transform
         )
 
+    def config(self):
+        return {"ssm": self.tf.identifier, "epsilon": EPSILON}
+
+    def requires(self):
+        return [self.tf.identifier]
+
     def preprocessor(self, wavPath, sr=SAMPLE_RATE):
-        pklPath = self.ssm_set.getPklPath(-1, wavPath=wavPath)
-        assert os.path.exists(
-            pklPath
-        ), f"{pklPath} not found, build GenerateSSM Preprocess_Dataset first"
-        with open(pklPath, "rb") as f:
-            ssm = pickle.load(f)
-        times, ssm = (ssm["times"], logSSM(ssm["ssm"])[0])
+        ssm = self.ssm_set.loadFeature(-1, wavPath=wavPath)
+        times, ssm = ssm["times"], decodeSSM(ssm["ssm"])[0]
         cliques = cliquesFromSSM((times, ssm))
         return {"times": times, "cliques": cliques}
 
@@ -179,15 +336,44 @@ class ExtractCliques(BaseTransform):
         return sample
 
 
-def getFeatures(dataset, idx):
-    tf = GenerateSSM(dataset=dataset)
-    ssm_set = Preprocess_Dataset(tf.identifier, dataset, transform=tf.transform)
-    ssmSample = ssm_set[idx]
-    ssm_f = ssmSample["times"], ssmSample["input"][0]
+class DatasetFeatures:
+    """features of the songs of a dataset, the transforms and the preprocessed
+    datasets are set up once per dataset instead of once per song"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        tf = GenerateSSM(dataset=dataset)
+        self.ssm_set = Preprocess_Dataset(
+            tf.identifier, dataset, transform=tf.transform
+        )
+        self.mel_set = tf.mel_set
+        self._cliques_set = None
+
+    @property
+    def cliques_set(self):
+        if self._cliques_set is None:
+            tf = ExtractCliques(dataset=self.dataset)
+            self._cliques_set = Preprocess_Dataset(
+                tf.identifier, self.dataset, transform=tf.transform
+            )
+        return self._cliques_set
+
+    def __getitem__(self, idx):
+        ssmSample = self.ssm_set[idx]
+        ssm_f = ssmSample["times"], ssmSample["input"][0]
+        melSample = self.mel_set[idx]
+        mels_f = melSample["times"], melSample["input"]
+        return ssm_f, mels_f
 
-    tf = ExtractMel()
-    mel_set = Preprocess_Dataset(tf.identifier, dataset, transform=tf.transform)
-    melSample = mel_set[idx]
-    mels_f = melSample["times"], melSample["input"]
+    def cliques(self, idx):
+        return self.cliques_set[idx]["cliques"]
 
-    return ssm_f, mels_f
+
+# keyed by the dataset object, a run touches a few datasets (train, val, predict)
+@lru_cache(maxsize=8)
+def datasetFeatures(dataset):
+    return DatasetFeatures(dataset)
+
+
+def getFeatures(dataset, idx):
+    return datasetFeatures(dataset)[idx]